@@ -1,19 +1,56 @@
-from flask import Flask, request, jsonify, send_file, has_request_context
+import time
+# Measured from before the first import, so /metrics shows how long a cold import takes
+_import_started = time.perf_counter()
+
+from flask import Flask, Response, g, request, jsonify, send_file, redirect, has_request_context
 from flask_cors import CORS
+from werkzeug.http import http_date, parse_date
+from werkzeug.security import safe_join
+import contextvars
+import hashlib
+import io
+import json
 import os
+import posixpath
+import threading
 import uuid
-import boto3
 import shutil
-import json
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
+from metrics import (
+    observe_request,
+    record_startup,
+    render_prometheus,
+    span,
+    start_profile,
+    stop_profile,
+    summarize,
+    timed,
+)
+from metadata_store import (
+    CachedMetadataStore,
+    LocalMetadataStore,
+    S3MetadataStore,
+    SQLiteMetadataStore,
+)
+from result_cache import LocalResultCache, ResultCache
 from utils import (
     audio_watermark as audio_watermark_util,
     extract_audio_watermark as extract_audio_watermark_util,
-    extract_audio_watermark_direct as extract_audio_watermark_direct_util,
+    bits_to_digest,
     image_watermark as image_watermark_util,
     extract_image_watermark_direct as extract_image_watermark_direct_util,
-    text_watermark as text_watermark_util,
-    extract_text_watermark as extract_text_watermark_util,
+    text_watermark_stream as text_watermark_stream_util,
+    text_watermark_batch as text_watermark_batch_util,
+    extract_text_watermark_stream as extract_text_watermark_stream_util,
+    extract_audio_watermark_direct_stream as extract_audio_watermark_direct_stream_util,
+    watermark_capacity as watermark_capacity_util,
+    PAYLOAD_VERSION,
+    COMPRESSION_ZLIB,
+    COMPRESSION_LZMA,
+    COMPRESSION_PNG,
 )
 
 app = Flask(__name__)
@@ -29,24 +66,198 @@ DISABLE_S3 = os.getenv('DISABLE_S3', '').strip() == '1'
 FILES_DIR = os.getenv('FILES_DIR', 'files')
 PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
 
-# Initialize S3 client if credentials exist and S3 isn't disabled
-_session = boto3.Session()
-_credentials = _session.get_credentials()
-S3_ENABLED = (not DISABLE_S3) and (_credentials is not None)
-s3_client = boto3.client('s3', region_name=AWS_REGION) if S3_ENABLED else None
-
-# Ensure upload directory exists
-UPLOAD_FOLDER = 'temp_uploads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(FILES_DIR, exist_ok=True)
 
-TEMP_RESULT_FILES = {
-    "audio_watermarked": os.path.join(FILES_DIR, "waudio.wav"),
-    "audio_extracted": os.path.join(FILES_DIR, "ewaudio.wav"),
-    "image_watermarked": os.path.join(FILES_DIR, "wiaudio.wav"),
-    "image_extracted": os.path.join(FILES_DIR, "extracted_image.jpg"),
-    "text_watermarked": os.path.join(FILES_DIR, "wtext.wav"),
+# Asynchronous job configuration
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '16'))
+# Bytes of each queued upload kept in memory; the rest spills to a temp file
+JOB_UPLOAD_SPOOL_BYTES = int(os.getenv('JOB_UPLOAD_SPOOL_BYTES', str(1024 * 1024)))
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+
+# Values of the embed endpoints' compression field
+COMPRESSIONS = (COMPRESSION_ZLIB, COMPRESSION_LZMA)
+IMAGE_COMPRESSIONS = COMPRESSIONS + (COMPRESSION_PNG,)
+
+# Batch embedding configuration
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '4'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '100'))
+
+# S3 transfer configuration. Every request thread, job worker and batch
+# publisher may run a transfer with up to S3_MAX_CONCURRENCY parts in
+# flight, and all of them share one client, so its connection pool is
+# sized to match instead of botocore's default of 10.
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '4'))
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', str(8 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '4'))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv(
+    'S3_MAX_POOL_CONNECTIONS',
+    str(max(10, S3_MAX_CONCURRENCY * (WORKER_THREADS + JOB_WORKERS + BATCH_WORKERS))),
+))
+S3_STREAM_CHUNK_BYTES = int(os.getenv('S3_STREAM_CHUNK_BYTES', str(256 * 1024)))
+
+# Download lookup configuration: how many filename -> key mappings each
+# process remembers, and whether S3 downloads redirect to a presigned URL
+# instead of proxying bytes (also available per request with ?redirect=1)
+DOWNLOAD_INDEX_SIZE = int(os.getenv('DOWNLOAD_INDEX_SIZE', '4096'))
+DOWNLOAD_REDIRECT = os.getenv('DOWNLOAD_REDIRECT', '').strip() == '1'
+PRESIGNED_URL_TTL = int(os.getenv('PRESIGNED_URL_TTL', '3600'))
+RESULT_PREFIXES = {
+    "audio_watermark": "watermarked",
+    "image_watermark": "image_watermarked",
+    "text_watermark": "text_watermarked",
 }
+# Top-level storage directories holding session outputs
+RESULT_DIRECTORIES = set(RESULT_PREFIXES.values()) | {"extracted", "downloads"}
+
+# Browser caching of served files: session outputs never change once
+# written, so browsers may keep them privately for RESULT_MAX_AGE seconds
+# and they are marked immutable; bundled samples are revalidated after SAMPLE_MAX_AGE
+RESULT_MAX_AGE = int(os.getenv('RESULT_MAX_AGE', str(365 * 24 * 3600)))
+SAMPLE_MAX_AGE = int(os.getenv('SAMPLE_MAX_AGE', '86400'))
+
+# Session metadata store: 's3', 'local' or 'sqlite' (defaults to S3 when it
+# is enabled, local JSON files otherwise), behind an in-process LRU cache
+METADATA_BACKEND = os.getenv('METADATA_BACKEND', '').strip().lower()
+# Kept out of LOCAL_STORAGE_DIR, which /api/local-file serves
+METADATA_SQLITE_PATH = os.getenv('METADATA_SQLITE_PATH', 'metadata.sqlite3')
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '1024'))
+METADATA_CACHE_TTL = float(os.getenv('METADATA_CACHE_TTL', '300'))
+
+# Content-addressed result cache: an embed request whose uploads, parameters
+# and codec version match an earlier one returns that result instead of
+# recomputing it. Local storage remembers at most RESULT_CACHE_MAX_ENTRIES
+# requests, forgetting the least recently used; results themselves are never
+# deleted, since their sessions still point at them.
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', '1').strip() != '0'
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '100000'))
+# Bump when the same inputs would embed differently, so older results stop matching
+RESULT_CACHE_VERSION = 1
+RESULT_HASH_CHUNK_BYTES = 1024 * 1024
+
+# Per-request profiling: send this header with a value of 1 to get the
+# stage breakdown back in Server-Timing and X-Profile-Stages headers
+PROFILE_HEADER = 'X-Profile'
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='watermark-job')
+_job_slots = threading.BoundedSemaphore(JOB_QUEUE_LIMIT)
+# Base URL of the request that queued the job, for URLs built off the request thread
+_job_base_url = contextvars.ContextVar('job_base_url', default='')
+
+_download_index = OrderedDict()
+_download_index_lock = threading.Lock()
+
+# Storage backends are built on first use, not at import: DISABLE_S3=1 never
+# imports boto3 or probes for credentials, and a gunicorn --preload master
+# holds no client or connection for its forked workers to share
+_process_state = {}
+_process_state_lock = threading.RLock()
+# Entries holding sockets, SQLite connections or threads, rebuilt after fork
+_FORK_UNSAFE_STATE = ('s3_client', 'metadata_store', 'result_cache')
+
+def _per_process(name, create):
+    """Return the object cached under name in this process, creating it on first use."""
+    try:
+        return _process_state[name]
+    except KeyError:
+        pass
+    with _process_state_lock:
+        if name not in _process_state:
+            with span(f'init_{name}'):
+                _process_state[name] = create()
+        return _process_state[name]
+
+def _reset_after_fork():
+    global _process_state_lock, _job_executor, _job_slots, _download_index_lock
+    for name in _FORK_UNSAFE_STATE:
+        _process_state.pop(name, None)
+    _process_state_lock = threading.RLock()
+    _download_index_lock = threading.Lock()
+    _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='watermark-job')
+    _job_slots = threading.BoundedSemaphore(JOB_QUEUE_LIMIT)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _probe_s3():
+    if DISABLE_S3:
+        return False
+    import boto3
+    return boto3.Session().get_credentials() is not None
+
+def _s3_enabled():
+    """Whether results live in S3: S3 isn't disabled and credentials resolve."""
+    return _per_process('s3_enabled', _probe_s3)
+
+def _create_s3_client():
+    import boto3
+    from botocore.config import Config
+    return boto3.Session().client(
+        's3',
+        region_name=AWS_REGION,
+        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+    )
+
+def _s3_client():
+    """The S3 client shared by every thread of this process."""
+    return _per_process('s3_client', _create_s3_client)
+
+def _create_transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=S3_MAX_CONCURRENCY,
+    )
+
+def _s3_transfer_config():
+    return _per_process('s3_transfer_config', _create_transfer_config)
+
+def _create_metadata_store():
+    backend = METADATA_BACKEND or ('s3' if _s3_enabled() else 'local')
+    if backend == 's3':
+        if not _s3_enabled():
+            raise RuntimeError("METADATA_BACKEND=s3 needs S3 to be enabled")
+        store = S3MetadataStore(_s3_client(), S3_BUCKET)
+    elif backend == 'local':
+        store = LocalMetadataStore(os.path.join(LOCAL_STORAGE_DIR, 'metadata'))
+    elif backend == 'sqlite':
+        store = SQLiteMetadataStore(METADATA_SQLITE_PATH)
+    else:
+        raise RuntimeError(f"Unknown METADATA_BACKEND: {backend}")
+    # Jobs in flight may be updated by another worker process, so only
+    # settled metadata is cached
+    return CachedMetadataStore(
+        store, METADATA_CACHE_SIZE, METADATA_CACHE_TTL,
+        cacheable=lambda metadata: metadata.get('status') not in (JOB_QUEUED, JOB_RUNNING),
+    )
+
+def _metadata_store():
+    return _per_process('metadata_store', _create_metadata_store)
+
+def _stored_object_exists(s3_key):
+    try:
+        _s3_client().head_object(Bucket=S3_BUCKET, Key=s3_key)
+    except _s3_client().exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+def _create_result_cache():
+    if not RESULT_CACHE_ENABLED:
+        return None
+    if _s3_enabled():
+        return ResultCache(S3MetadataStore(_s3_client(), S3_BUCKET, prefix='result-cache/'), _stored_object_exists)
+    return LocalResultCache(os.path.join(LOCAL_STORAGE_DIR, 'result-cache'), LOCAL_STORAGE_DIR, RESULT_CACHE_MAX_ENTRIES)
+
+def _result_cache():
+    return _per_process('result_cache', _create_result_cache)
+
 SAMPLE_FILES = {
     "radiohead.wav": "audio/wav",
     "creep.wav": "audio/wav",
@@ -61,6 +272,8 @@ def _ensure_local_path(s3_key):
 def _public_base_url():
     if PUBLIC_BASE_URL:
         return PUBLIC_BASE_URL
+    if _job_base_url.get():
+        return _job_base_url.get()
     if has_request_context():
         forwarded_proto = request.headers.get('X-Forwarded-Proto', request.scheme)
         forwarded_host = request.headers.get('X-Forwarded-Host', request.host)
@@ -75,65 +288,405 @@ def _local_file_url(s3_key):
         return f"{base_url}{relative_path}"
     return relative_path
 
-def _store_metadata(session_id, metadata):
-    if S3_ENABLED:
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=f"metadata/{session_id}.json",
-            Body=json.dumps(metadata),
-            ContentType='application/json'
-        )
-        return
-    metadata_path = _ensure_local_path(f"metadata/{session_id}.json")
-    with open(metadata_path, 'w') as metadata_file:
-        json.dump(metadata, metadata_file)
+@timed('load_metadata')
+def _load_metadata(session_id):
+    return _metadata_store().load(session_id)
 
-def _move_temp_result(source_path, destination_path):
-    if not os.path.exists(source_path):
-        raise FileNotFoundError(f"Expected output file missing: {source_path}")
-    shutil.move(source_path, destination_path)
+@timed('store_metadata')
+def _store_metadata(session_id, metadata):
+    _metadata_store().store(session_id, metadata)
 
-def _cleanup_paths(*paths):
-    for path in paths:
-        if path and os.path.exists(path):
-            os.remove(path)
+def _is_path(source):
+    return isinstance(source, (str, os.PathLike))
 
 def upload_to_s3(file_path, s3_key):
-    """Upload file to S3 bucket or local storage"""
-    if not S3_ENABLED:
+    """Upload a file path or file object to S3 bucket or local storage"""
+    if _is_path(file_path):
+        size = os.path.getsize(file_path)
+    else:
+        size = file_path.seek(0, os.SEEK_END)
+        file_path.seek(0)
+    with span('upload_to_s3', size):
+        return _upload(file_path, s3_key)
+
+def _upload(file_path, s3_key):
+    if not _s3_enabled():
         local_path = _ensure_local_path(s3_key)
-        shutil.copyfile(file_path, local_path)
+        if _is_path(file_path):
+            shutil.copyfile(file_path, local_path)
+        else:
+            with open(local_path, 'wb') as local_file:
+                shutil.copyfileobj(file_path, local_file)
         return _local_file_url(s3_key)
     try:
-        s3_client.upload_file(file_path, S3_BUCKET, s3_key)
-        # Return a signed URL that works for 7 days instead of public URL
-        url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET, 'Key': s3_key},
-            ExpiresIn=604800  # 7 days
-        )
-        return url
+        if _is_path(file_path):
+            _s3_client().upload_file(file_path, S3_BUCKET, s3_key, Config=_s3_transfer_config())
+        else:
+            _s3_client().upload_fileobj(file_path, S3_BUCKET, s3_key, Config=_s3_transfer_config())
+        return _stored_file_url(s3_key)
     except Exception as e:
         raise Exception(f"Failed to upload to S3: {str(e)}")
 
-def download_from_s3(s3_key, local_path):
-    """Download file from S3 bucket or local storage"""
-    if not S3_ENABLED:
-        source_path = os.path.join(LOCAL_STORAGE_DIR, s3_key)
-        if not os.path.exists(source_path):
+def _stored_file_url(s3_key):
+    """URL of an object already in S3 or local storage."""
+    if not _s3_enabled():
+        return _local_file_url(s3_key)
+    # Return a signed URL that works for 7 days instead of public URL
+    return _s3_client().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET, 'Key': s3_key},
+        ExpiresIn=604800  # 7 days
+    )
+
+@timed('open_stored_file')
+def _open_stored_file(s3_key):
+    """Return a readable source for a stored object without staging it on disk.
+
+    Local storage hands back the stored path itself; S3 objects are read
+    straight from the get_object response body as the caller consumes them.
+    """
+    if not _s3_enabled():
+        local_path = os.path.join(LOCAL_STORAGE_DIR, s3_key)
+        if not os.path.exists(local_path):
             raise Exception("File not found in local storage")
-        shutil.copyfile(source_path, local_path)
-        return True
+        return local_path
     try:
-        s3_client.download_file(S3_BUCKET, s3_key, local_path)
-        return True
+        return _s3_client().get_object(Bucket=S3_BUCKET, Key=s3_key)['Body']
     except Exception as e:
         raise Exception(f"Failed to download from S3: {str(e)}")
 
+def _result_cache_control(response):
+    # Outputs belong to one session, so shared proxies and CDNs must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = RESULT_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+def _send_result_file(path, download_name):
+    """Serve a stored session output with Range, ETag and Last-Modified support.
+
+    send_file answers Range requests with 206 and matching If-None-Match or
+    If-Modified-Since requests with 304; outputs never change, so clients
+    may also cache them outright.
+    """
+    response = send_file(path, as_attachment=True, download_name=download_name, max_age=RESULT_MAX_AGE)
+    return _result_cache_control(response)
+
+def _s3_request_params(s3_key, with_range=True):
+    """get_object parameters carrying the client's Range and conditional headers."""
+    params = {'Bucket': S3_BUCKET, 'Key': s3_key}
+    if request.if_none_match:
+        params['IfNoneMatch'] = request.headers['If-None-Match']
+    elif request.if_modified_since:
+        params['IfModifiedSince'] = request.if_modified_since
+    range_header = request.headers.get('Range')
+    if with_range and range_header:
+        params['Range'] = range_header
+        # Only send the range if the client still has this version of the object
+        if_range = request.headers.get('If-Range')
+        if if_range and parse_date(if_range):
+            params['IfUnmodifiedSince'] = parse_date(if_range)
+        elif if_range:
+            params['IfMatch'] = if_range
+    return params
+
+def _stream_s3_object(s3_key, download_name):
+    """Proxy an S3 object to the client in chunks, never holding it whole.
+
+    Range, If-Range and conditional headers are passed on to S3, so clients
+    can seek (206) and revalidate (304) through the proxy too.
+    """
+    try:
+        s3_object = _s3_client().get_object(**_s3_request_params(s3_key))
+    except _s3_client().exceptions.ClientError as e:
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        if status == 304:
+            response = Response(status=304)
+            if headers.get('etag'):
+                response.headers['ETag'] = headers['etag']
+            return _result_cache_control(response)
+        if status == 412 and request.headers.get('If-Range'):
+            # The object changed since the client cached part of it: send it whole
+            s3_object = _s3_client().get_object(**_s3_request_params(s3_key, with_range=False))
+        elif status == 416:
+            size = e.response.get('Error', {}).get('ActualObjectSize', '*')
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        else:
+            raise
+    body = s3_object['Body']
+    
+    def generate():
+        try:
+            yield from body.iter_chunks(S3_STREAM_CHUNK_BYTES)
+        finally:
+            body.close()
+    
+    headers = {
+        "Content-Type": s3_object.get('ContentType') or 'application/octet-stream',
+        "Content-Length": str(s3_object['ContentLength']),
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(download_name)}",
+        "Accept-Ranges": "bytes",
+    }
+    if s3_object.get('ETag'):
+        headers["ETag"] = s3_object['ETag']
+    if s3_object.get('LastModified'):
+        headers["Last-Modified"] = http_date(s3_object['LastModified'])
+    if s3_object.get('ContentRange'):
+        headers["Content-Range"] = s3_object['ContentRange']
+    status = 206 if s3_object.get('ContentRange') else 200
+    return _result_cache_control(Response(generate(), status=status, headers=headers))
+
+def _remember_download(s3_key):
+    """Record which key a result filename lives under, evicting the oldest entries."""
+    with _download_index_lock:
+        _download_index[os.path.basename(s3_key)] = s3_key
+        _download_index.move_to_end(os.path.basename(s3_key))
+        while len(_download_index) > DOWNLOAD_INDEX_SIZE:
+            _download_index.popitem(last=False)
+
+def _resolve_download_key(filename):
+    """Map a result filename to its storage key with at most one metadata read.
+
+    Results published by this process are found in the in-process index.
+    Otherwise the session id in the filename leads to the session metadata;
+    extracted files always live under extracted/.
+    """
+    with _download_index_lock:
+        s3_key = _download_index.get(filename)
+        if s3_key:
+            _download_index.move_to_end(filename)
+            return s3_key
+    
+    session_id, _, suffix = filename.partition('_')
+    try:
+        uuid.UUID(session_id)
+    except ValueError:
+        return None
+    if suffix.startswith('extracted.'):
+        s3_key = f"extracted/{filename}"
+    elif suffix == 'result.wav':
+        try:
+            metadata = _load_metadata(session_id)
+        except Exception:
+            return None
+        s3_key = metadata.get('result_s3_key')
+        if not s3_key:
+            prefix = RESULT_PREFIXES.get(metadata.get('type'))
+            if not prefix:
+                return None
+            s3_key = f"{prefix}/{filename}"
+    else:
+        return None
+    _remember_download(s3_key)
+    return s3_key
+
+def _result_target(s3_key):
+    """Where a util should write a result: straight into local storage, or a buffer bound for S3."""
+    if _s3_enabled():
+        return io.BytesIO()
+    return _ensure_local_path(s3_key)
+
+def _publish_result(target, s3_key):
+    """Return the URL of a result written to a _result_target, uploading it if needed."""
+    _remember_download(s3_key)
+    if _s3_enabled():
+        return upload_to_s3(target, s3_key)
+    return _local_file_url(s3_key)
+
+def _upload_digest(upload):
+    """SHA-256 of a seekable upload, leaving it positioned where it was."""
+    digest = hashlib.sha256()
+    start = upload.tell()
+    with span('hash_upload') as stage:
+        for block in iter(lambda: upload.read(RESULT_HASH_CHUNK_BYTES), b''):
+            digest.update(block)
+            stage.add_bytes(len(block))
+    upload.seek(start)
+    return digest.hexdigest()
+
+def _result_cache_key(result_type, upload_digests, **params):
+    """Content address of an embed request: uploads, parameters and codec version."""
+    request_identity = [result_type, PAYLOAD_VERSION, RESULT_CACHE_VERSION, upload_digests, params]
+    return hashlib.sha256(json.dumps(request_identity, sort_keys=True).encode()).hexdigest()
+
+def _cached_result(cache_key):
+    """Return (session_id, result_url) of an earlier identical embed, or None."""
+    result_cache = _result_cache()
+    if result_cache is None:
+        return None
+    entry = result_cache.get(cache_key)
+    if entry is None:
+        return None
+    _remember_download(entry['result_s3_key'])
+    return entry['session_id'], _stored_file_url(entry['result_s3_key'])
+
+def _remember_result(cache_key, session_id, result_s3_key):
+    result_cache = _result_cache()
+    if result_cache is not None:
+        result_cache.put(cache_key, {"session_id": session_id, "result_s3_key": result_s3_key})
+
+def _invalid_compression(compression, allowed=COMPRESSIONS):
+    """Return a 400 response for an unsupported compression field, else None."""
+    if compression is None or compression in allowed:
+        return None
+    return jsonify({"error": f"compression must be one of: {', '.join(allowed)}"}), 400
+
+def _wants_job(data=None):
+    """Whether the caller asked for the request to run as an asynchronous job."""
+    flag = request.args.get('async') or request.form.get('async') or (data or {}).get('async')
+    return str(flag or '').strip().lower() in ('1', 'true')
+
+def _buffer_upload(file_storage):
+    """Copy an upload so a job can read it after the request ends.
+
+    Only the first JOB_UPLOAD_SPOOL_BYTES stay in memory, so a full queue
+    of large uploads waits on disk rather than in the worker.
+    """
+    spool = tempfile.SpooledTemporaryFile(JOB_UPLOAD_SPOOL_BYTES)
+    with span('buffer_upload') as stage:
+        shutil.copyfileobj(file_storage.stream, spool)
+        stage.add_bytes(spool.tell())
+    spool.seek(0)
+    return spool
+
+def _update_job(job_id, **fields):
+    """Merge job state into the job's session metadata."""
+    try:
+        metadata = _load_metadata(job_id)
+    except Exception:
+        metadata = {"session_id": job_id}
+    metadata.update(fields)
+    _store_metadata(job_id, metadata)
+
+def _run_job(job_id, base_url, work, args):
+    # Progress is coarse: 0.1 once a worker picks the job up, 1.0 when it ends
+    _job_base_url.set(base_url)
+    try:
+        _update_job(job_id, status=JOB_RUNNING, progress=0.1)
+        result = work(job_id, *args)
+        _update_job(job_id, status=JOB_COMPLETED, progress=1.0, result=result)
+    except Exception as e:
+        _update_job(job_id, status=JOB_FAILED, progress=1.0, error=str(e) or type(e).__name__)
+    finally:
+        for arg in args:
+            if isinstance(arg, tempfile.SpooledTemporaryFile):
+                arg.close()
+        _job_slots.release()
+
+def _submit_job(job_id, job_type, work, *args):
+    """Queue work(job_id, *args) on the job pool and answer 202 with the job id.
+
+    work returns the JSON body the synchronous endpoint would have sent; it
+    ends up under "result" in GET /api/jobs/<job_id>.
+    """
+    if not _job_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many queued jobs, try again later"}), 503
+    try:
+        _store_metadata(job_id, {
+            "session_id": job_id,
+            "type": job_type,
+            "status": JOB_QUEUED,
+            "progress": 0.0,
+        })
+        _job_executor.submit(_run_job, job_id, _public_base_url(), work, args)
+    except Exception:
+        # _run_job never started, so it will not release the slot
+        _job_slots.release()
+        raise
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status": JOB_QUEUED,
+        "status_url": f"/api/jobs/{job_id}",
+    }), 202
+
+@app.before_request
+def _start_request_metrics():
+    g.request_start = time.perf_counter()
+    if request.headers.get(PROFILE_HEADER, '').strip().lower() in ('1', 'true'):
+        g.profile_token = start_profile()
+    # Uploads are parsed on first access; time it here rather than inside each endpoint
+    if request.mimetype == 'multipart/form-data':
+        with span('parse_upload', request.content_length or 0):
+            request.files
+
+@app.after_request
+def _finish_request_metrics(response):
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe_request(endpoint, response.status_code, seconds)
+    token = g.pop('profile_token', None)
+    if token is not None:
+        stages = summarize(stop_profile(token))
+        timings = [f'total;dur={seconds * 1000:.3f}']
+        timings.extend(
+            f'{stage["stage"]};dur={stage["seconds"] * 1000:.3f};desc="{stage["calls"]} calls, {stage["bytes"]} bytes"'
+            for stage in stages
+        )
+        response.headers['Server-Timing'] = ', '.join(timings)
+        response.headers['X-Profile-Stages'] = json.dumps(stages)
+    return response
+
+@app.teardown_request
+def _discard_profile(exc):
+    # Request threads are reused, so a profile must never outlive its request
+    token = g.pop('profile_token', None)
+    if token is not None:
+        stop_profile(token)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy", "service": "AudioTracked API"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Stage and request timings of this worker process, in the Prometheus text format"""
+    return Response(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class RequestError(Exception):
+    """A client-facing error raised by endpoint work, carrying its HTTP status."""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _audio_watermark_work(session_id, host, watermark, compression=None):
+    message = "Audio watermarking completed successfully"
+    cache_key = _result_cache_key("audio_watermark", [_upload_digest(host), _upload_digest(watermark)],
+                                  compression=compression)
+    cached = _cached_result(cache_key)
+    if cached:
+        session_id, result_url = cached
+        return {"success": True, "session_id": session_id, "result_url": result_url, "message": message, "cached": True}
+    
+    # Process watermarking straight from the upload streams
+    result_s3_key = f"watermarked/{session_id}_result.wav"
+    result = _result_target(result_s3_key)
+    with span('audio_watermark'):
+        watermark_digest = audio_watermark_util(host, watermark, output=result, compression=compression)
+    
+    # Upload to S3
+    result_url = _publish_result(result, result_s3_key)
+    
+    # Store metadata in S3
+    metadata = {
+        "session_id": session_id,
+        "type": "audio_watermark",
+        "watermark_digest": watermark_digest,
+        "result_url": result_url,
+        "result_s3_key": result_s3_key
+    }
+    _store_metadata(session_id, metadata)
+    _remember_result(cache_key, session_id, result_s3_key)
+    
+    return {
+        "success": True,
+        "session_id": session_id,
+        "result_url": result_url,
+        "message": message
+    }
+
 @app.route('/api/audio-watermark', methods=['POST'])
 def embed_audio_watermark_endpoint():
     """Embed audio file into another audio file"""
@@ -149,48 +702,58 @@ def embed_audio_watermark_endpoint():
         
         # Generate unique IDs for files
         session_id = str(uuid.uuid4())
-        # Save temp files
-        host_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_host.wav")
-        watermark_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_watermark.wav")
-        
-        host_file.save(host_path)
-        watermark_file.save(watermark_path)
-        
-        # Process watermarking
-        small_audio_bits = audio_watermark_util(host_path, watermark_path)
-        
-        # Save result - the utils function saves to "files/waudio.wav"
-        temp_result = TEMP_RESULT_FILES["audio_watermarked"]
-        result_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_result.wav")
-        _move_temp_result(temp_result, result_path)
-        
-        # Upload to S3
-        result_s3_key = f"watermarked/{session_id}_result.wav"
-        result_url = upload_to_s3(result_path, result_s3_key)
+        compression = request.form.get('compression') or None
+        invalid = _invalid_compression(compression)
+        if invalid:
+            return invalid
         
-        # Store metadata in S3
-        metadata = {
-            "session_id": session_id,
-            "type": "audio_watermark",
-            "small_audio_bits": small_audio_bits,
-            "result_url": result_url,
-            "result_s3_key": result_s3_key
-        }
-        _store_metadata(session_id, metadata)
-        
-        # Cleanup temp files
-        _cleanup_paths(host_path, watermark_path, result_path)
-        
-        return jsonify({
-            "success": True,
-            "session_id": session_id,
-            "result_url": result_url,
-            "message": "Audio watermarking completed successfully"
-        })
+        if _wants_job():
+            return _submit_job(session_id, "audio_watermark", _audio_watermark_work,
+                               _buffer_upload(host_file), _buffer_upload(watermark_file), compression)
+        return jsonify(_audio_watermark_work(session_id, host_file.stream, watermark_file.stream, compression))
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _extract_audio_watermark_work(job_id, session_id):
+    # Download metadata
+    try:
+        metadata = _load_metadata(session_id)
+        watermark_digest = metadata.get('watermark_digest')
+        if watermark_digest is None:
+            # Sessions created before digests stored every payload bit
+            watermark_digest = bits_to_digest(metadata.pop('small_audio_bits'))
+            metadata['watermark_digest'] = watermark_digest
+            _store_metadata(session_id, metadata)
+        result_s3_key = metadata.get('result_s3_key')
+        if not result_s3_key:
+            result_url = metadata.get('result_url', '')
+            result_s3_key = result_url.split('?')[0].split('/')[-1]
+        if not result_s3_key.startswith("watermarked/"):
+            result_s3_key = f"watermarked/{result_s3_key}"
+    except Exception:
+        raise RequestError("Session not found", 404)
+    
+    # Open watermarked file
+    watermarked = _open_stored_file(result_s3_key)
+    
+    # Extract watermark
+    extracted_s3_key = f"extracted/{session_id}_extracted.wav"
+    extracted = _result_target(extracted_s3_key)
+    with span('extract_audio_watermark'):
+        matched = extract_audio_watermark_util(watermarked, watermark_digest, output=extracted)
+    if not matched:
+        raise RequestError("Embedded audio does not match this session", 409)
+    
+    # Upload extracted audio
+    extracted_url = _publish_result(extracted, extracted_s3_key)
+    
+    return {
+        "success": True,
+        "extracted_url": extracted_url,
+        "message": "Audio watermark extracted successfully"
+    }
+
 @app.route('/api/audio-watermark/extract', methods=['POST'])
 def extract_audio_watermark_endpoint():
     """Extract embedded audio from watermarked file"""
@@ -201,52 +764,33 @@ def extract_audio_watermark_endpoint():
         if not session_id:
             return jsonify({"error": "session_id is required"}), 400
         
-        # Download metadata
-        try:
-            if S3_ENABLED:
-                metadata_response = s3_client.get_object(
-                    Bucket=S3_BUCKET,
-                    Key=f"metadata/{session_id}.json"
-                )
-                metadata = json.loads(metadata_response['Body'].read())
-            else:
-                metadata_path = os.path.join(LOCAL_STORAGE_DIR, f"metadata/{session_id}.json")
-                with open(metadata_path, 'r') as metadata_file:
-                    metadata = json.load(metadata_file)
-            small_audio_bits = metadata['small_audio_bits']
-            result_s3_key = metadata.get('result_s3_key')
-            if not result_s3_key:
-                result_url = metadata.get('result_url', '')
-                result_s3_key = result_url.split('?')[0].split('/')[-1]
-            if not result_s3_key.startswith("watermarked/"):
-                result_s3_key = f"watermarked/{result_s3_key}"
-        except Exception:
-            return jsonify({"error": "Session not found"}), 404
-        
-        # Download watermarked file
-        watermarked_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_watermarked.wav")
-        download_from_s3(result_s3_key, watermarked_path)
-        
-        # Extract watermark
-        extract_audio_watermark_util(watermarked_path, small_audio_bits)
-        
-        # Upload extracted audio
-        extracted_path = TEMP_RESULT_FILES["audio_extracted"]
-        extracted_s3_key = f"extracted/{session_id}_extracted.wav"
-        extracted_url = upload_to_s3(extracted_path, extracted_s3_key)
-        
-        # Cleanup
-        _cleanup_paths(watermarked_path, extracted_path)
-        
-        return jsonify({
-            "success": True,
-            "extracted_url": extracted_url,
-            "message": "Audio watermark extracted successfully"
-        })
+        if _wants_job(data):
+            job_id = str(uuid.uuid4())
+            return _submit_job(job_id, "audio_extract", _extract_audio_watermark_work, session_id)
+        return jsonify(_extract_audio_watermark_work(None, session_id))
         
+    except RequestError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _direct_extract_audio_watermark_work(session_id, audio):
+    # Stream the upload straight into the extracted result
+    extracted_s3_key = f"extracted/{session_id}_extracted.wav"
+    result = _result_target(extracted_s3_key)
+    with span('extract_audio_watermark_direct_stream'):
+        extracted_size = extract_audio_watermark_direct_stream_util(audio, result)
+    
+    # Upload extracted audio
+    extracted_url = _publish_result(result, extracted_s3_key)
+    
+    return {
+        "success": True,
+        "extracted_url": extracted_url,
+        "extracted_size": extracted_size,
+        "message": "Audio watermark extracted successfully"
+    }
+
 @app.route('/api/audio-watermark/direct-extract', methods=['POST'])
 def direct_extract_audio_watermark_endpoint():
     """Directly extract embedded audio from uploaded watermarked file"""
@@ -257,35 +801,52 @@ def direct_extract_audio_watermark_endpoint():
         audio_file = request.files['audio']
         session_id = str(uuid.uuid4())
         
-        # Save temp file
-        audio_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_watermarked.wav")
-        audio_file.save(audio_path)
-        
-        # Extract watermark using direct method
-        extracted_size = extract_audio_watermark_direct_util(audio_path)
-        
-        # Move result - the utils function saves to "files/ewaudio.wav"
-        temp_result = TEMP_RESULT_FILES["audio_extracted"]
-        result_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_extracted.wav")
-        _move_temp_result(temp_result, result_path)
-        
-        # Upload extracted audio
-        extracted_s3_key = f"extracted/{session_id}_extracted.wav"
-        extracted_url = upload_to_s3(result_path, extracted_s3_key)
-        
-        # Cleanup
-        _cleanup_paths(audio_path, result_path)
-        
-        return jsonify({
-            "success": True,
-            "extracted_url": extracted_url,
-            "extracted_size": extracted_size,
-            "message": "Audio watermark extracted successfully"
-        })
+        if _wants_job():
+            return _submit_job(session_id, "audio_direct_extract", _direct_extract_audio_watermark_work,
+                               _buffer_upload(audio_file))
+        return jsonify(_direct_extract_audio_watermark_work(session_id, audio_file.stream))
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _image_watermark_work(session_id, audio, image, compression=None):
+    message = "Image watermarking completed successfully"
+    cache_key = _result_cache_key("image_watermark", [_upload_digest(audio), _upload_digest(image)],
+                                  compression=compression)
+    cached = _cached_result(cache_key)
+    if cached:
+        session_id, result_url = cached
+        return {"success": True, "session_id": session_id, "result_url": result_url, "message": message, "cached": True}
+    
+    # Process watermarking straight from the upload streams
+    result_s3_key = f"image_watermarked/{session_id}_result.wav"
+    result = _result_target(result_s3_key)
+    with span('image_watermark'):
+        w, h, index = image_watermark_util(audio, image, output=result, compression=compression)
+    
+    # Upload to S3
+    result_url = _publish_result(result, result_s3_key)
+    
+    # Store metadata
+    metadata = {
+        "session_id": session_id,
+        "type": "image_watermark",
+        "width": w,
+        "height": h,
+        "index": index,
+        "result_url": result_url,
+        "result_s3_key": result_s3_key
+    }
+    _store_metadata(session_id, metadata)
+    _remember_result(cache_key, session_id, result_s3_key)
+    
+    return {
+        "success": True,
+        "session_id": session_id,
+        "result_url": result_url,
+        "message": message
+    }
+
 @app.route('/api/image-watermark', methods=['POST'])
 def embed_image_watermark_endpoint():
     """Embed image into audio file"""
@@ -297,51 +858,38 @@ def embed_image_watermark_endpoint():
         image_file = request.files['image']
         
         session_id = str(uuid.uuid4())
+        compression = request.form.get('compression') or None
+        invalid = _invalid_compression(compression, IMAGE_COMPRESSIONS)
+        if invalid:
+            return invalid
         
-        # Save temp files
-        audio_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_audio.wav")
-        image_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_image.jpg")
-        
-        audio_file.save(audio_path)
-        image_file.save(image_path)
-        
-        # Process watermarking
-        w, h, index = image_watermark_util(audio_path, image_path)
-        
-        # Move result - the utils function saves to "files/wiaudio.wav"
-        temp_result = TEMP_RESULT_FILES["image_watermarked"]
-        result_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_result.wav")
-        _move_temp_result(temp_result, result_path)
-        
-        # Upload to S3
-        result_s3_key = f"image_watermarked/{session_id}_result.wav"
-        result_url = upload_to_s3(result_path, result_s3_key)
-        
-        # Store metadata
-        metadata = {
-            "session_id": session_id,
-            "type": "image_watermark",
-            "width": w,
-            "height": h,
-            "index": index,
-            "result_url": result_url,
-            "result_s3_key": result_s3_key
-        }
-        _store_metadata(session_id, metadata)
-        
-        # Cleanup
-        _cleanup_paths(audio_path, image_path, result_path)
-        
-        return jsonify({
-            "success": True,
-            "session_id": session_id,
-            "result_url": result_url,
-            "message": "Image watermarking completed successfully"
-        })
+        if _wants_job():
+            return _submit_job(session_id, "image_watermark", _image_watermark_work,
+                               _buffer_upload(audio_file), _buffer_upload(image_file), compression)
+        return jsonify(_image_watermark_work(session_id, audio_file.stream, image_file.stream, compression))
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _direct_extract_image_watermark_work(session_id, audio):
+    # Extract watermark using direct method straight from the upload stream
+    extracted_s3_key = f"extracted/{session_id}_extracted.jpg"
+    result = _result_target(extracted_s3_key)
+    with span('extract_image_watermark_direct'):
+        width, height, extracted_bits = extract_image_watermark_direct_util(audio, output=result)
+    
+    # Upload extracted image
+    extracted_url = _publish_result(result, extracted_s3_key)
+    
+    return {
+        "success": True,
+        "extracted_url": extracted_url,
+        "width": width,
+        "height": height,
+        "extracted_bits": extracted_bits,
+        "message": "Image watermark extracted successfully"
+    }
+
 @app.route('/api/image-watermark/direct-extract', methods=['POST'])
 def direct_extract_image_watermark_endpoint():
     """Directly extract embedded image from uploaded watermarked file"""
@@ -352,37 +900,49 @@ def direct_extract_image_watermark_endpoint():
         audio_file = request.files['audio']
         session_id = str(uuid.uuid4())
         
-        # Save temp file
-        audio_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_watermarked.wav")
-        audio_file.save(audio_path)
-        
-        # Extract watermark using direct method
-        width, height, extracted_bits = extract_image_watermark_direct_util(audio_path)
-        
-        # Move result - the utils function saves to "files/extracted_image.jpg"
-        temp_result = TEMP_RESULT_FILES["image_extracted"]
-        result_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_extracted.jpg")
-        _move_temp_result(temp_result, result_path)
-        
-        # Upload extracted image
-        extracted_s3_key = f"extracted/{session_id}_extracted.jpg"
-        extracted_url = upload_to_s3(result_path, extracted_s3_key)
-        
-        # Cleanup
-        _cleanup_paths(audio_path, result_path)
-        
-        return jsonify({
-            "success": True,
-            "extracted_url": extracted_url,
-            "width": width,
-            "height": height,
-            "extracted_bits": extracted_bits,
-            "message": "Image watermark extracted successfully"
-        })
+        if _wants_job():
+            return _submit_job(session_id, "image_direct_extract", _direct_extract_image_watermark_work,
+                               _buffer_upload(audio_file))
+        return jsonify(_direct_extract_image_watermark_work(session_id, audio_file.stream))
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _text_watermark_work(session_id, text, audio, compression=None):
+    message = "Text watermarking completed successfully"
+    cache_key = _result_cache_key("text_watermark", [_upload_digest(audio)], text=text, compression=compression)
+    cached = _cached_result(cache_key)
+    if cached:
+        session_id, result_url = cached
+        return {"success": True, "session_id": session_id, "result_url": result_url, "message": message, "cached": True}
+    
+    # Stream the upload through the watermarker into the result
+    result_s3_key = f"text_watermarked/{session_id}_result.wav"
+    result = _result_target(result_s3_key)
+    with span('text_watermark_stream'):
+        text_watermark_stream_util(text, audio, result, compression=compression)
+    
+    # Upload to S3
+    result_url = _publish_result(result, result_s3_key)
+    
+    # Store metadata
+    metadata = {
+        "session_id": session_id,
+        "type": "text_watermark",
+        "text": text,
+        "result_url": result_url,
+        "result_s3_key": result_s3_key
+    }
+    _store_metadata(session_id, metadata)
+    _remember_result(cache_key, session_id, result_s3_key)
+    
+    return {
+        "success": True,
+        "session_id": session_id,
+        "result_url": result_url,
+        "message": message
+    }
+
 @app.route('/api/text-watermark', methods=['POST'])
 def embed_text_watermark_endpoint():
     """Embed text into audio file"""
@@ -396,46 +956,114 @@ def embed_text_watermark_endpoint():
         
         audio_file = request.files['audio']
         session_id = str(uuid.uuid4())
+        compression = request.form.get('compression') or None
+        invalid = _invalid_compression(compression)
+        if invalid:
+            return invalid
         
-        # Save temp file
-        audio_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_audio.wav")
-        audio_file.save(audio_path)
+        if _wants_job():
+            return _submit_job(session_id, "text_watermark", _text_watermark_work,
+                               text, _buffer_upload(audio_file), compression)
+        return jsonify(_text_watermark_work(session_id, text, audio_file.stream, compression))
         
-        # Process watermarking
-        text_watermark_util(text, audio_path)
-        
-        # Move result - the utils function saves to "files/wtext.wav"
-        temp_result = TEMP_RESULT_FILES["text_watermarked"]
-        result_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_result.wav")
-        _move_temp_result(temp_result, result_path)
-        
-        # Upload to S3
-        result_s3_key = f"text_watermarked/{session_id}_result.wav"
-        result_url = upload_to_s3(result_path, result_s3_key)
-        
-        # Store metadata
-        metadata = {
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def _text_watermark_batch_work(batch_id, texts, audio, compression=None):
+    # Texts embedded into this host before come straight from the result cache
+    host_digest = _upload_digest(audio)
+    cache_keys = [_result_cache_key("text_watermark", [host_digest], text=text, compression=compression) for text in texts]
+    manifest = [None] * len(texts)
+    for position, cache_key in enumerate(cache_keys):
+        cached = _cached_result(cache_key)
+        if cached:
+            session_id, result_url = cached
+            manifest[position] = {"session_id": session_id, "text": texts[position], "result_url": result_url, "cached": True}
+    pending = [position for position, item in enumerate(manifest) if item is None]
+    
+    # One session per remaining text, all cut from the same decoded host
+    session_ids = [str(uuid.uuid4()) for _ in pending]
+    pending_texts = [texts[position] for position in pending]
+    result_s3_keys = [f"text_watermarked/{session_id}_result.wav" for session_id in session_ids]
+    results = [_result_target(result_s3_key) for result_s3_key in result_s3_keys]
+    
+    def publish(index, bits):
+        session_id, text, result_s3_key = session_ids[index], pending_texts[index], result_s3_keys[index]
+        result_url = _publish_result(results[index], result_s3_key)
+        # Drop an uploaded buffer now, so only the outputs in flight are held
+        if isinstance(results[index], io.BytesIO):
+            results[index].close()
+        _store_metadata(session_id, {
             "session_id": session_id,
             "type": "text_watermark",
             "text": text,
+            "batch_id": batch_id,
             "result_url": result_url,
             "result_s3_key": result_s3_key
-        }
-        _store_metadata(session_id, metadata)
+        })
+        _remember_result(cache_keys[pending[index]], session_id, result_s3_key)
+        manifest[pending[index]] = {"session_id": session_id, "text": text, "result_url": result_url}
+    
+    # Each output is uploaded and recorded by the thread that wrote it
+    base_url = _public_base_url()
+    def publish_with_base_url(*args):
+        _job_base_url.set(base_url)
+        return publish(*args)
+    # Each thread runs in its own copy of this context, so a profiled request sees its uploads
+    context = contextvars.copy_context()
+    def publish_in_context(*args):
+        return context.copy().run(publish_with_base_url, *args)
+    if pending:
+        with span('text_watermark_batch'):
+            text_watermark_batch_util(pending_texts, audio, results, max_workers=BATCH_WORKERS,
+                                      compression=compression, on_output=publish_in_context)
+    
+    return {
+        "success": True,
+        "batch_id": batch_id,
+        "results": manifest,
+        "message": f"Text watermarking completed for {len(manifest)} messages"
+    }
+
+@app.route('/api/text-watermark/batch', methods=['POST'])
+def embed_text_watermark_batch_endpoint():
+    """Embed many texts into copies of one audio file in a single pass"""
+    try:
+        if 'audio' not in request.files:
+            return jsonify({"error": "Audio file is required"}), 400
         
-        # Cleanup
-        _cleanup_paths(audio_path, result_path)
+        texts = [text for text in request.form.getlist('text') if text]
+        if not texts:
+            return jsonify({"error": "At least one text message is required"}), 400
+        if len(texts) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"At most {BATCH_MAX_ITEMS} text messages per batch"}), 400
         
-        return jsonify({
-            "success": True,
-            "session_id": session_id,
-            "result_url": result_url,
-            "message": "Text watermarking completed successfully"
-        })
+        audio_file = request.files['audio']
+        batch_id = str(uuid.uuid4())
+        compression = request.form.get('compression') or None
+        invalid = _invalid_compression(compression)
+        if invalid:
+            return invalid
+        
+        if _wants_job():
+            return _submit_job(batch_id, "text_watermark_batch", _text_watermark_batch_work,
+                               texts, _buffer_upload(audio_file), compression)
+        return jsonify(_text_watermark_batch_work(batch_id, texts, audio_file.stream, compression))
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _extract_text_watermark_work(job_id, audio):
+    # Extract text, reading the upload only as far as the terminator
+    with span('extract_text_watermark_stream'):
+        extracted_text = extract_text_watermark_stream_util(audio)
+    
+    return {
+        "success": True,
+        "extracted_text": extracted_text,
+        "message": "Text watermark extracted successfully"
+    }
+
 @app.route('/api/text-watermark/extract', methods=['POST'])
 def extract_text_watermark_endpoint():
     """Extract text from watermarked audio"""
@@ -444,33 +1072,76 @@ def extract_text_watermark_endpoint():
             return jsonify({"error": "Audio file is required"}), 400
         
         audio_file = request.files['audio']
-        session_id = str(uuid.uuid4())
-        
-        # Save temp file
-        audio_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_audio.wav")
-        audio_file.save(audio_path)
         
-        # Extract text
-        extracted_text = extract_text_watermark_util(audio_path)
+        if _wants_job():
+            job_id = str(uuid.uuid4())
+            return _submit_job(job_id, "text_extract", _extract_text_watermark_work,
+                               _buffer_upload(audio_file))
+        return jsonify(_extract_text_watermark_work(None, audio_file.stream))
         
-        # Cleanup
-        _cleanup_paths(audio_path)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/capacity', methods=['POST'])
+def capacity_endpoint():
+    """Report how much payload an audio file can carry, reading only file headers"""
+    try:
+        if 'audio' not in request.files:
+            return jsonify({"error": "Audio file is required"}), 400
         
-        return jsonify({
-            "success": True,
-            "extracted_text": extracted_text,
-            "message": "Text watermark extracted successfully"
-        })
+        channel = request.form.get('channel')
+        if channel is not None and not channel.lstrip('-').isdigit():
+            return jsonify({"error": "channel must be an integer"}), 400
+        image_file = request.files.get('image')
+        watermark_file = request.files.get('watermark')
+        
+        capacity = watermark_capacity_util(
+            request.files['audio'].stream,
+            text=request.form.get('text'),
+            image=image_file.stream if image_file else None,
+            watermark=watermark_file.stream if watermark_file else None,
+            codec=request.form.get('codec') or None,
+            channel=int(channel) if channel is not None else None,
+        )
+        return jsonify({"success": True, **capacity})
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the status, progress and result of an asynchronous job"""
+    try:
+        metadata = _load_metadata(job_id)
+    except Exception:
+        return jsonify({"error": "Job not found"}), 404
+    # Sessions created synchronously have no job state and are already done
+    status = metadata.get('status', JOB_COMPLETED)
+    response = {
+        "job_id": job_id,
+        "type": metadata.get('type'),
+        "status": status,
+        "progress": metadata.get('progress', 1.0 if status == JOB_COMPLETED else 0.0),
+    }
+    if status == JOB_COMPLETED:
+        response["result"] = metadata.get('result') or {
+            key: metadata[key] for key in ("session_id", "result_url") if key in metadata
+        }
+    elif status == JOB_FAILED:
+        response["error"] = metadata.get('error')
+    return jsonify(response)
+
 @app.route('/api/download/<filename>')
 def download_file(filename):
     """Download a file by serving the S3 content directly"""
     try:
-        if not S3_ENABLED:
+        s3_key = _resolve_download_key(filename)
+        
+        if not _s3_enabled():
             local_candidates = [
+                os.path.join(LOCAL_STORAGE_DIR, s3_key) if s3_key else None,
                 os.path.join(LOCAL_STORAGE_DIR, "watermarked", filename),
                 os.path.join(LOCAL_STORAGE_DIR, "image_watermarked", filename),
                 os.path.join(LOCAL_STORAGE_DIR, "text_watermarked", filename),
@@ -478,38 +1149,31 @@ def download_file(filename):
                 os.path.join(LOCAL_STORAGE_DIR, "downloads", filename),
             ]
             for candidate in local_candidates:
-                if os.path.exists(candidate):
-                    return send_file(candidate, as_attachment=True, download_name=filename)
+                if candidate and os.path.exists(candidate):
+                    return _send_result_file(candidate, filename)
             return jsonify({"error": "File not found"}), 404
 
-        # Get the file from S3
-        s3_key = f"downloads/{filename}"
+        if not s3_key:
+            return jsonify({"error": "File not found"}), 404
         
-        # Check if file exists in different folders
+        # Hand the client a presigned URL so S3 serves the bytes directly
+        if DOWNLOAD_REDIRECT or request.args.get('redirect') == '1':
+            url = _s3_client().generate_presigned_url(
+                'get_object',
+                Params={
+                    'Bucket': S3_BUCKET,
+                    'Key': s3_key,
+                    'ResponseContentDisposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+                },
+                ExpiresIn=PRESIGNED_URL_TTL
+            )
+            return redirect(url, code=302)
+        
+        # Stream the object through without staging it on disk
         try:
-            s3_client.head_object(Bucket=S3_BUCKET, Key=f"watermarked/{filename}")
-            s3_key = f"watermarked/{filename}"
-        except:
-            try:
-                s3_client.head_object(Bucket=S3_BUCKET, Key=f"image_watermarked/{filename}")
-                s3_key = f"image_watermarked/{filename}"
-            except:
-                try:
-                    s3_client.head_object(Bucket=S3_BUCKET, Key=f"text_watermarked/{filename}")
-                    s3_key = f"text_watermarked/{filename}"
-                except:
-                    try:
-                        s3_client.head_object(Bucket=S3_BUCKET, Key=f"extracted/{filename}")
-                        s3_key = f"extracted/{filename}"
-                    except:
-                        return jsonify({"error": "File not found"}), 404
-        
-        # Create a temporary file to download from S3
-        temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{filename}")
-        s3_client.download_file(S3_BUCKET, s3_key, temp_path)
-        
-        # Send the file
-        return send_file(temp_path, as_attachment=True, download_name=filename)
+            return _stream_s3_object(s3_key, filename)
+        except _s3_client().exceptions.NoSuchKey:
+            return jsonify({"error": "File not found"}), 404
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -517,13 +1181,15 @@ def download_file(filename):
 @app.route('/api/local-file/<path:s3_key>')
 def local_file(s3_key):
     """Serve locally stored files when S3 is disabled."""
-    if S3_ENABLED:
+    if _s3_enabled():
         return jsonify({"error": "Local file serving is disabled when S3 is enabled"}), 400
-    local_path = os.path.join(LOCAL_STORAGE_DIR, s3_key)
-    if not os.path.exists(local_path):
+    # Only session outputs are public; metadata and the result index are not.
+    # The directory is checked after normalising, so "../" cannot step out of it
+    s3_key = posixpath.normpath(s3_key)
+    local_path = safe_join(LOCAL_STORAGE_DIR, s3_key)
+    if local_path is None or s3_key.split('/', 1)[0] not in RESULT_DIRECTORIES or not os.path.isfile(local_path):
         return jsonify({"error": "File not found"}), 404
-    filename = os.path.basename(local_path)
-    return send_file(local_path, as_attachment=True, download_name=filename)
+    return _send_result_file(local_path, os.path.basename(local_path))
 
 @app.route('/api/sample/<filename>')
 def sample_file(filename):
@@ -533,7 +1199,7 @@ def sample_file(filename):
     sample_path = os.path.join(FILES_DIR, filename)
     if not os.path.exists(sample_path):
         return jsonify({"error": "Sample file missing on server"}), 404
-    return send_file(sample_path, mimetype=SAMPLE_FILES[filename], as_attachment=False)
+    return send_file(sample_path, mimetype=SAMPLE_FILES[filename], as_attachment=False, max_age=SAMPLE_MAX_AGE)
 
 @app.route('/config.js')
 def frontend_config():
@@ -545,6 +1211,8 @@ def index():
     """Serve the web interface"""
     return send_file(os.path.join('frontend', 'index.html'))
 
+record_startup('import', time.perf_counter() - _import_started)
+
 if __name__ == '__main__':
     port = int(os.getenv("PORT", "5001"))
     debug = os.getenv("FLASK_DEBUG", "").strip() == "1"
@@ -0,0 +1,417 @@
+"""Benchmarks for the utils.py embed and extract functions.
+
+Generates a deterministic corpus of synthetic WAV hosts (mono and stereo,
+8/16/24-bit, seconds to an hour long) plus text, image and audio payloads,
+then times every embed and extract function against each host, plus a
+cold import of app.py. Every case runs in a fresh process so its peak RSS
+is its own. Results are written as
+JSON keyed by a stable case id, so two runs can be diffed:
+
+    python benchmark.py run --preset quick -o before.json
+    python benchmark.py run --preset quick -o after.json
+    python benchmark.py compare before.json after.json
+
+PARALLEL_WORKERS, STREAM_CHUNK_FRAMES and the other utils.py settings are
+read from the environment as usual and recorded with the results.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+from PIL import Image
+
+import utils
+from utils import (
+    text_watermark,
+    text_watermark_batch,
+    text_watermark_stream,
+    extract_text_watermark,
+    extract_text_watermark_stream,
+    audio_watermark,
+    audio_watermark_stream,
+    extract_audio_watermark,
+    extract_audio_watermark_direct,
+    extract_audio_watermark_direct_stream,
+    image_watermark,
+    extract_image_watermark,
+    extract_image_watermark_direct,
+    watermark_capacity,
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+FRAME_RATE = 44100
+GENERATE_CHUNK_FRAMES = 1 << 18
+# Host durations in seconds for each preset
+PRESETS = {
+    'quick': [5, 30],
+    'standard': [5, 60, 600],
+    'full': [5, 60, 600, 3600],
+}
+# (channels, sample width in bytes) of every generated host
+FORMATS = [(1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3)]
+BATCH_MESSAGES = 8
+TEXT_BYTES = 1024
+IMAGE_SIZE = (128, 128)
+WATERMARK_SECONDS = 1
+WATERMARK_FRAME_RATE = 8000
+
+# Watermarked hosts the extract cases read: fixture -> (payload, header)
+FIXTURES = {
+    'text': ('text', True),
+    'text-headerless': ('text', False),
+    'audio': ('watermark', True),
+    'image': ('image', True),
+    'image-headerless': ('image', False),
+}
+
+def _output(ctx, suffix):
+    return os.path.join(ctx['out_dir'], f"output{suffix}")
+
+# Each case: (name, payload, header, fixture, host copies processed, function)
+CASES = [
+    ('text_watermark', 'text', True, None, 1,
+     lambda ctx: text_watermark(ctx['text'], ctx['host'], output=_output(ctx, '.wav'))),
+    ('text_watermark_stream', 'text', True, None, 1,
+     lambda ctx: text_watermark_stream(ctx['text'], ctx['host'], _output(ctx, '.wav'))),
+    ('text_watermark_batch', 'text', True, None, BATCH_MESSAGES,
+     lambda ctx: text_watermark_batch([ctx['text']] * BATCH_MESSAGES, ctx['host'],
+                                      [_output(ctx, f'-{i}.wav') for i in range(BATCH_MESSAGES)])),
+    ('audio_watermark', 'watermark', True, None, 1,
+     lambda ctx: audio_watermark(ctx['host'], ctx['watermark'], output=_output(ctx, '.wav'))),
+    ('audio_watermark_stream', 'watermark', True, None, 1,
+     lambda ctx: audio_watermark_stream(ctx['host'], ctx['watermark'], _output(ctx, '.wav'))),
+    ('image_watermark', 'image', True, None, 1,
+     lambda ctx: image_watermark(ctx['host'], ctx['image'], output=_output(ctx, '.wav'))),
+    ('extract_text_watermark', 'text', True, 'text', 1,
+     lambda ctx: extract_text_watermark(ctx['fixture'])),
+    ('extract_text_watermark[headerless]', 'text', False, 'text-headerless', 1,
+     lambda ctx: extract_text_watermark(ctx['fixture'])),
+    ('extract_text_watermark_stream', 'text', True, 'text', 1,
+     lambda ctx: extract_text_watermark_stream(ctx['fixture'])),
+    ('extract_audio_watermark', 'watermark', True, 'audio', 1,
+     lambda ctx: extract_audio_watermark(ctx['fixture'], ctx['digest'], output=_output(ctx, '.wav'))),
+    ('extract_audio_watermark_direct', 'watermark', True, 'audio', 1,
+     lambda ctx: extract_audio_watermark_direct(ctx['fixture'], output=_output(ctx, '.wav'))),
+    ('extract_audio_watermark_direct_stream', 'watermark', True, 'audio', 1,
+     lambda ctx: extract_audio_watermark_direct_stream(ctx['fixture'], _output(ctx, '.wav'))),
+    ('extract_image_watermark', 'image', True, 'image', 1,
+     lambda ctx: extract_image_watermark(ctx['fixture'], *IMAGE_SIZE, IMAGE_SIZE[0] * IMAGE_SIZE[1] * 8,
+                                         output=_output(ctx, '.jpg'))),
+    ('extract_image_watermark_direct', 'image', True, 'image', 1,
+     lambda ctx: extract_image_watermark_direct(ctx['fixture'], output=_output(ctx, '.jpg'))),
+    # No header, so this times the dimension search
+    ('extract_image_watermark_direct[search]', 'image', False, 'image-headerless', 1,
+     lambda ctx: extract_image_watermark_direct(ctx['fixture'], output=_output(ctx, '.jpg'))),
+]
+CASE_FUNCTIONS = {name: function for name, _, _, _, _, function in CASES}
+
+def _format_id(num_channels, sample_width, seconds):
+    return f"{num_channels}ch-{sample_width * 8}bit-{seconds}s"
+
+def _synthetic_samples(start, num_frames, num_channels, sample_width, rng):
+    """Return the sample bytes of a tone plus noise, as a real recording's LSBs would be."""
+    t = (np.arange(start, start + num_frames) / FRAME_RATE)[:, None]
+    freqs = 220.0 * np.arange(1, num_channels + 1)
+    signal = 0.5 * np.sin(2 * np.pi * freqs * t) + 0.05 * rng.standard_normal((num_frames, num_channels))
+    peak = (1 << (sample_width * 8 - 1)) - 1
+    values = np.clip(signal, -1.0, 1.0) * peak
+    if sample_width == 1:
+        return (values + 128).astype(np.uint8).tobytes()
+    if sample_width == 2:
+        return values.astype('<i2').tobytes()
+    # 24-bit: the low three bytes of each little-endian int32
+    return values.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+
+def generate_host(path, num_channels, sample_width, seconds, seed=0):
+    """Write a synthetic host WAV in chunks, so hour-long hosts never sit in memory."""
+    rng = np.random.default_rng([seed, num_channels, sample_width, seconds])
+    total_frames = seconds * FRAME_RATE
+    with wave.open(path, 'wb') as writer:
+        writer.setparams((num_channels, sample_width, FRAME_RATE, total_frames, 'NONE', 'not compressed'))
+        for start in range(0, total_frames, GENERATE_CHUNK_FRAMES):
+            num_frames = min(GENERATE_CHUNK_FRAMES, total_frames - start)
+            writer.writeframesraw(_synthetic_samples(start, num_frames, num_channels, sample_width, rng))
+    return path
+
+def generate_payloads(directory, seed=0):
+    """Write the text, image and audio payloads every case embeds."""
+    rng = np.random.default_rng(seed)
+    words = ['catalogue', 'master', 'take', 'mix', 'session', 'rights', 'owner', 'release']
+    text = ''
+    while len(text) < TEXT_BYTES:
+        text += rng.choice(words) + ' '
+    text = text[:TEXT_BYTES]
+
+    # Smooth shapes and gradients, so the headerless dimension search has a real image to find
+    width, height = IMAGE_SIZE
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = 96 + 64 * np.sin(x / 9.0) * np.cos(y / 13.0) + 0.4 * x
+    pixels[(x - width / 2) ** 2 + (y - height / 3) ** 2 < (width / 5) ** 2] = 230
+    image_path = os.path.join(directory, 'payload.png')
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), mode='L').save(image_path)
+
+    watermark_path = os.path.join(directory, 'payload.wav')
+    num_frames = WATERMARK_SECONDS * WATERMARK_FRAME_RATE
+    tone = 0.5 * np.sin(2 * np.pi * 440 * np.arange(num_frames) / WATERMARK_FRAME_RATE)
+    with wave.open(watermark_path, 'wb') as writer:
+        writer.setparams((1, 1, WATERMARK_FRAME_RATE, num_frames, 'NONE', 'not compressed'))
+        writer.writeframes((tone * 127 + 128).astype(np.uint8).tobytes())
+    return {'text': text, 'image': image_path, 'watermark': watermark_path}
+
+def _fits(host, payloads, payload, header):
+    capacity = watermark_capacity(host, header=header, **{payload: payloads[payload]})
+    return capacity['fits']
+
+def _make_fixture(fixture, host, payloads, directory):
+    payload, header = FIXTURES[fixture]
+    path = os.path.join(directory, f"fixture-{fixture}.wav")
+    digest = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        if payload == 'text':
+            text_watermark(payloads['text'], host, header=header, output=path)
+        elif payload == 'watermark':
+            digest = audio_watermark(host, payloads['watermark'], header=header, output=path)
+        else:
+            image_watermark(host, payloads['image'], header=header, output=path)
+    return path, digest
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _measure(name, ctx, repeat):
+    """Run one case repeat times in this (fresh) process and time each run."""
+    function = CASE_FUNCTIONS[name]
+    baseline = _peak_rss()
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(ctx)
+            seconds.append(time.perf_counter() - start)
+    return seconds, baseline, _peak_rss()
+
+def run_case(name, ctx, repeat=3):
+    """Time one case in a new process and return (seconds per run, peak RSS, RSS growth)."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        seconds, baseline, peak = executor.submit(_measure, name, ctx, repeat).result()
+    growth = peak - baseline if peak is not None and baseline is not None else None
+    return seconds, peak, growth
+
+# Run in a fresh interpreter: how long a cold worker takes to import app.py
+_STARTUP_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+seconds = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([seconds, peak if sys.platform == 'darwin' else peak * 1024]))
+"""
+
+def measure_startup(repeat=3):
+    """Time importing app.py in new interpreters with S3 disabled.
+
+    Returns (wall seconds per run including interpreter start, import
+    seconds per run, peak RSS).
+    """
+    env = dict(os.environ, DISABLE_S3='1')
+    runs, imports, peak = [], [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT], capture_output=True, text=True, check=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+        runs.append(time.perf_counter() - start)
+        import_seconds, run_peak = json.loads(completed.stdout.splitlines()[-1])
+        imports.append(import_seconds)
+        peak = max(peak, run_peak)
+    return runs, imports, peak
+
+def _metadata(args):
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        "created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "revision": revision,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parallel_workers": utils.PARALLEL_WORKERS,
+        "stream_chunk_frames": utils.STREAM_CHUNK_FRAMES,
+        "durations": args.durations,
+        "formats": [f"{num_channels}x{sample_width * 8}" for num_channels, sample_width in args.formats],
+        "repeat": args.repeat,
+        "seed": args.seed,
+    }
+
+def run_benchmarks(args, log=print):
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='audiotracked-bench-')
+    os.makedirs(corpus_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='audiotracked-bench-work-')
+    cases = [case for case in CASES if not args.cases or any(pattern in case[0] for pattern in args.cases)]
+    results = []
+    if not args.cases or any(pattern in 'app_import' for pattern in args.cases):
+        result = {"id": "startup/app_import", "case": "app_import"}
+        results.append(result)
+        try:
+            runs, imports, peak = measure_startup(args.repeat)
+        except (subprocess.CalledProcessError, ValueError, IndexError) as e:
+            result.update(ok=False, error=str(e))
+            log(f"FAIL  {result['id']}: {result['error']}")
+        else:
+            result.update(
+                ok=True,
+                wall_seconds=runs,
+                median_seconds=statistics.median(runs),
+                min_seconds=min(runs),
+                import_seconds=statistics.median(imports),
+                peak_rss_bytes=peak,
+            )
+            log(f"ok    {result['median_seconds']:8.3f}s {'':14} {peak / 1e6:8.1f} MB peak  {result['id']}")
+    try:
+        payloads = generate_payloads(work_dir, args.seed)
+        for seconds in args.durations:
+            for num_channels, sample_width in args.formats:
+                format_id = _format_id(num_channels, sample_width, seconds)
+                host = os.path.join(corpus_dir, f"host-{format_id}-seed{args.seed}.wav")
+                if not os.path.exists(host):
+                    log(f"generating {host}")
+                    generate_host(host, num_channels, sample_width, seconds, args.seed)
+                host_bytes = seconds * FRAME_RATE * num_channels * sample_width
+                fixtures = {}
+                for name, payload, header, fixture, copies, _ in cases:
+                    result = {
+                        "id": f"{name}/{format_id}",
+                        "case": name,
+                        "channels": num_channels,
+                        "sample_width": sample_width,
+                        "duration_seconds": seconds,
+                        "bytes": host_bytes * copies,
+                    }
+                    results.append(result)
+                    if not _fits(host, payloads, payload, header):
+                        result.update(ok=False, skipped="payload does not fit in host")
+                        continue
+                    ctx = dict(payloads, host=host, out_dir=work_dir)
+                    try:
+                        if fixture is not None:
+                            if fixture not in fixtures:
+                                fixtures[fixture] = _make_fixture(fixture, host, payloads, work_dir)
+                            ctx['fixture'], ctx['digest'] = fixtures[fixture]
+                        runs, peak, growth = run_case(name, ctx, args.repeat)
+                    except Exception as e:
+                        result.update(ok=False, error=str(e) or type(e).__name__)
+                        log(f"FAIL  {result['id']}: {result['error']}")
+                        continue
+                    median = statistics.median(runs)
+                    result.update(
+                        ok=True,
+                        wall_seconds=runs,
+                        median_seconds=median,
+                        min_seconds=min(runs),
+                        mb_per_second=result["bytes"] / 1e6 / median if median else 0.0,
+                        peak_rss_bytes=peak,
+                        rss_growth_bytes=growth,
+                    )
+                    log(f"ok    {median:8.3f}s {result['mb_per_second']:9.1f} MB/s "
+                        f"{(peak or 0) / 1e6:8.1f} MB peak  {result['id']}")
+                for path, _ in fixtures.values():
+                    os.remove(path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+    return {"meta": _metadata(args), "results": results}
+
+def compare_results(baseline, current, threshold=0.1):
+    """Return (id, metric, old, new, ratio) for every case that got worse by more than threshold."""
+    old = {result["id"]: result for result in baseline["results"] if result.get("ok")}
+    regressions = []
+    for result in current["results"]:
+        previous = old.get(result["id"])
+        if previous is None or not result.get("ok"):
+            continue
+        for metric in ("median_seconds", "peak_rss_bytes"):
+            if not previous.get(metric) or result.get(metric) is None:
+                continue
+            ratio = result[metric] / previous[metric]
+            if ratio > 1 + threshold:
+                regressions.append((result["id"], metric, previous[metric], result[metric], ratio))
+    return regressions
+
+def _parse_format(value):
+    channels, _, bits = value.partition('x')
+    try:
+        num_channels, sample_width = int(channels), int(bits) // 8
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected CHANNELSxBITS such as 2x16, got {value!r}")
+    if num_channels < 1 or int(bits) not in (8, 16, 24):
+        raise argparse.ArgumentTypeError(f"unsupported format {value!r}")
+    return num_channels, sample_width
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the utils.py watermarking functions")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run', help="generate the corpus and time every case")
+    run.add_argument('--preset', choices=PRESETS, default='quick', help="host durations to run (default: quick)")
+    run.add_argument('--durations', type=int, nargs='+', help="host durations in seconds, overriding --preset")
+    run.add_argument('--formats', type=_parse_format, nargs='+', default=FORMATS,
+                     help="host formats as CHANNELSxBITS, e.g. 1x8 2x16 (default: mono and stereo at 8, 16 and 24 bits)")
+    run.add_argument('--cases', nargs='+', help="only run cases whose name contains one of these strings")
+    run.add_argument('--repeat', type=int, default=3, help="timed runs per case; the median is reported")
+    run.add_argument('--seed', type=int, default=0, help="seed for the synthetic corpus")
+    run.add_argument('--corpus-dir', help="keep generated hosts here and reuse them on later runs")
+    run.add_argument('-o', '--output', help="write the JSON results here instead of stdout")
+    compare = subparsers.add_parser('compare', help="report cases that regressed between two result files")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help="relative slowdown or memory growth that counts as a regression (default: 0.1)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file, open(args.current) as current_file:
+            regressions = compare_results(json.load(baseline_file), json.load(current_file), args.threshold)
+        for case_id, metric, old, new, ratio in regressions:
+            print(f"{case_id}: {metric} {old:.6g} -> {new:.6g} ({ratio - 1:+.1%})")
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+        return 1 if regressions else 0
+
+    args.durations = args.durations or PRESETS[args.preset]
+    # Progress goes to stderr so stdout stays valid JSON
+    report = run_benchmarks(args, log=lambda line: print(line, file=sys.stderr, flush=True))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if any(result.get("error") for result in report["results"]) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
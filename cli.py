@@ -0,0 +1,222 @@
+"""Command-line batch watermarking over utils.py.
+
+Runs embed or extract jobs over every WAV in a set of directories, files or
+manifests on a process pool, writing results to an output directory and
+reporting per-file timings and overall throughput.
+
+    python cli.py embed-text music/ -o out/ --text "catalogue 2024"
+    python cli.py extract-text out/ -o extracted/ --json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import (
+    text_watermark_stream,
+    extract_text_watermark_stream,
+    audio_watermark_stream,
+    extract_audio_watermark_direct_stream,
+    image_watermark,
+    extract_image_watermark_direct,
+)
+
+# Output filename suffix for each command
+OUTPUT_SUFFIXES = {
+    'embed-text': '_wtext.wav',
+    'embed-audio': '_waudio.wav',
+    'embed-image': '_wiaudio.wav',
+    'extract-text': '.txt',
+    'extract-audio': '_ewaudio.wav',
+    'extract-image': '_extracted.jpg',
+}
+
+def _embed_text(source, output, options):
+    bits = text_watermark_stream(options['text'], source, output, header=options['header'],
+                                 codec=options['codec'], channel=options['channel'],
+                                 compression=options['compression'])
+    return {"embedded_bits": bits}
+
+def _embed_audio(source, output, options):
+    bits = audio_watermark_stream(source, options['watermark'], output, header=options['header'],
+                                  codec=options['codec'], channel=options['channel'],
+                                  compression=options['compression'])
+    return {"embedded_bits": bits}
+
+def _embed_image(source, output, options):
+    width, height, bits = image_watermark(source, options['image'], header=options['header'], output=output,
+                                          codec=options['codec'], channel=options['channel'],
+                                          compression=options['compression'])
+    return {"width": width, "height": height, "embedded_bits": bits}
+
+def _extract_text(source, output, options):
+    text = extract_text_watermark_stream(source)
+    with open(output, 'w', encoding='utf-8') as text_file:
+        text_file.write(text)
+    return {"text": text}
+
+def _extract_audio(source, output, options):
+    return {"extracted_bytes": extract_audio_watermark_direct_stream(source, output)}
+
+def _extract_image(source, output, options):
+    width, height, index = extract_image_watermark_direct(source, output=output)
+    return {"width": width, "height": height, "index": index}
+
+COMMANDS = {
+    'embed-text': _embed_text,
+    'embed-audio': _embed_audio,
+    'embed-image': _embed_image,
+    'extract-text': _extract_text,
+    'extract-audio': _extract_audio,
+    'extract-image': _extract_image,
+}
+
+def _run_task(command, source, output, options):
+    """Run one job in a worker process and report how long it took."""
+    start = time.perf_counter()
+    report = {"input": source, "output": output, "bytes": 0}
+    try:
+        report["bytes"] = os.path.getsize(source)
+        report.update(COMMANDS[command](source, output, options))
+        report["ok"] = True
+    except Exception as e:
+        report["ok"] = False
+        report["error"] = str(e) or type(e).__name__
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+def _read_manifest(path):
+    """Return (wav_path, text) pairs from a manifest, one path per line.
+
+    A tab after the path gives that file its own text for embed-text.
+    Blank lines and lines starting with # are ignored; relative paths are
+    taken relative to the manifest.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    entries = []
+    with open(path, encoding='utf-8') as manifest:
+        for line in manifest:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            wav_path, _, text = line.partition('\t')
+            entries.append((os.path.join(base_dir, wav_path.strip()), text or None))
+    return entries
+
+def collect_inputs(paths, manifests=()):
+    """Expand directories, WAV files and manifests into (wav_path, text) pairs."""
+    entries = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                entries.extend((os.path.join(root, name), None) for name in sorted(files) if name.lower().endswith('.wav'))
+        else:
+            entries.append((path, None))
+    for manifest in manifests:
+        entries.extend(_read_manifest(manifest))
+    return [(os.path.abspath(wav_path), text) for wav_path, text in entries]
+
+def _output_path(command, source, out_dir, used):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    name = stem + OUTPUT_SUFFIXES[command]
+    # Same-named files from different directories must not overwrite each other
+    count = 1
+    while name in used:
+        count += 1
+        name = f"{stem}-{count}{OUTPUT_SUFFIXES[command]}"
+    used.add(name)
+    return os.path.join(out_dir, name)
+
+def run_batch(command, entries, out_dir, options, workers=None, on_result=None):
+    """Run command over entries on a process pool and return the per-file reports."""
+    os.makedirs(out_dir, exist_ok=True)
+    used = set()
+    reports = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for source, text in entries:
+            task_options = dict(options, text=text) if text is not None else options
+            output = _output_path(command, source, out_dir, used)
+            futures.append(executor.submit(_run_task, command, source, output, task_options))
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            if on_result:
+                on_result(report)
+    return reports
+
+def _summary(reports, seconds):
+    total_bytes = sum(report["bytes"] for report in reports)
+    return {
+        "files": len(reports),
+        "failed": sum(not report["ok"] for report in reports),
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "mb_per_second": total_bytes / 1e6 / seconds if seconds else 0.0,
+    }
+
+def _print_report(report):
+    if report["ok"]:
+        rate = report["bytes"] / 1e6 / report["seconds"] if report["seconds"] else 0.0
+        print(f"ok    {report['seconds']:8.3f}s {rate:8.1f} MB/s  {report['input']} -> {report['output']}")
+    else:
+        print(f"FAIL  {report['seconds']:8.3f}s {'':13}  {report['input']}: {report['error']}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Bulk audio watermarking and extraction")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in COMMANDS:
+        sub = subparsers.add_parser(command)
+        sub.add_argument('inputs', nargs='*', help="WAV files or directories to scan for WAVs")
+        sub.add_argument('-m', '--manifest', action='append', default=[], help="file listing one WAV path per line")
+        sub.add_argument('-o', '--out-dir', required=True, help="directory results are written to")
+        sub.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: all CPU cores)")
+        sub.add_argument('--json', action='store_true', help="print one JSON object per file and a JSON summary")
+        if command.startswith('embed-'):
+            sub.add_argument('--no-header', dest='header', action='store_false', help="embed without the payload header")
+            sub.add_argument('--codec', choices=('sample', 'byte'), default=None,
+                             help="carrier layout (default: sample with a header, byte without)")
+            sub.add_argument('--channel', type=int, default=None, help="embed into this channel only (sample codec)")
+            sub.add_argument('--compression', choices=('zlib', 'lzma', 'png') if command == 'embed-image' else ('zlib', 'lzma'),
+                             default=None, help="compress the payload before embedding")
+    subparsers.choices['embed-text'].add_argument('--text', help="text to embed (manifest lines may override it)")
+    subparsers.choices['embed-audio'].add_argument('--watermark', required=True, help="WAV file to embed")
+    subparsers.choices['embed-image'].add_argument('--image', required=True, help="image file to embed")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    entries = collect_inputs(args.inputs, args.manifest)
+    if not entries:
+        parser.error("no input WAV files found")
+    if args.command == 'embed-text' and args.text is None and any(text is None for _, text in entries):
+        parser.error("--text is required unless every manifest line carries its own text")
+    if args.command.startswith('embed-') and not args.header and (args.codec == 'sample' or args.channel is not None):
+        parser.error("--no-header only supports the byte codec on every channel")
+
+    options = {
+        "header": getattr(args, 'header', True),
+        "codec": getattr(args, 'codec', None),
+        "channel": getattr(args, 'channel', None),
+        "compression": getattr(args, 'compression', None),
+    }
+    for name in ('text', 'watermark', 'image'):
+        if getattr(args, name, None) is not None:
+            options[name] = os.path.abspath(getattr(args, name)) if name != 'text' else args.text
+
+    on_result = (lambda report: print(json.dumps(report), flush=True)) if args.json else _print_report
+    start = time.perf_counter()
+    reports = run_batch(args.command, entries, args.out_dir, options, args.workers, on_result)
+    summary = _summary(reports, time.perf_counter() - start)
+    if args.json:
+        print(json.dumps({"summary": summary}))
+    else:
+        print(f"{summary['files']} files, {summary['failed']} failed, "
+              f"{summary['bytes'] / 1e6:.1f} MB in {summary['seconds']:.2f}s ({summary['mb_per_second']:.1f} MB/s)")
+    return 1 if summary["failed"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
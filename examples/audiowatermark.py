@@ -4,5 +4,5 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 from utils import audio_watermark, extract_audio_watermark
 
-small_audio_bits = audio_watermark("radiohead.wav", "creep.wav")
-extract_audio_watermark("waudio.wav", small_audio_bits)
+watermark_digest = audio_watermark("radiohead.wav", "creep.wav")
+extract_audio_watermark("waudio.wav", watermark_digest)
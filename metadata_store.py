@@ -0,0 +1,158 @@
+"""Session metadata stores used by app.py.
+
+Every store has load(session_id) -> dict, raising KeyError when the
+session is unknown, and store(session_id, metadata). CachedMetadataStore
+wraps any of them with an in-process LRU cache whose entries expire after
+a TTL, so hot sessions are not fetched and parsed again on every request.
+"""
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class S3MetadataStore:
+    """Metadata as JSON objects under metadata/ in an S3 bucket."""
+
+    def __init__(self, client, bucket, prefix='metadata/'):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def load(self, session_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{session_id}.json")
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(session_id)
+        return json.loads(response['Body'].read())
+
+    def store(self, session_id, metadata):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{session_id}.json",
+            Body=json.dumps(metadata),
+            ContentType='application/json'
+        )
+
+
+class LocalMetadataStore:
+    """Metadata as JSON files in a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def load(self, session_id):
+        try:
+            with open(self._path(session_id), 'r') as metadata_file:
+                return json.load(metadata_file)
+        except FileNotFoundError:
+            raise KeyError(session_id)
+
+    def store(self, session_id, metadata):
+        os.makedirs(self.directory, exist_ok=True)
+        metadata_path = self._path(session_id)
+        # Write then rename so concurrent readers never see a half-written file
+        temp_path = f"{metadata_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(temp_path, metadata_path)
+
+
+class SQLiteMetadataStore:
+    """Metadata rows in a local SQLite database, shared by every worker process.
+
+    Stands in for a shared key-value store on single-host deployments. Each
+    thread gets its own connection; WAL mode lets readers run alongside a
+    writer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "session_id TEXT PRIMARY KEY, body TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def load(self, session_id):
+        row = self._connection().execute(
+            "SELECT body FROM metadata WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(session_id)
+        return json.loads(row[0])
+
+    def store(self, session_id, metadata):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO metadata (session_id, body, updated_at) VALUES (?, ?, ?)",
+                (session_id, json.dumps(metadata), time.time())
+            )
+
+
+class CachedMetadataStore:
+    """LRU cache with per-entry TTL in front of another metadata store.
+
+    Writes go through to the backing store and refresh the cache. Metadata
+    for which cacheable(metadata) is false, such as jobs still in progress
+    that another process may update, is never cached. Callers get copies,
+    so mutating a loaded dict never changes the cached one.
+    """
+
+    def __init__(self, store, max_entries=1024, ttl=300.0, cacheable=None):
+        self.store_backend = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cacheable = cacheable or (lambda metadata: True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, session_id, metadata):
+        if self.max_entries <= 0 or not self.cacheable(metadata):
+            self.invalidate(session_id)
+            return
+        with self._lock:
+            self._entries[session_id] = (time.monotonic() + self.ttl, copy.deepcopy(metadata))
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def load(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                expires_at, metadata = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(session_id)
+                    return copy.deepcopy(metadata)
+                del self._entries[session_id]
+        metadata = self.store_backend.load(session_id)
+        self._remember(session_id, metadata)
+        return metadata
+
+    def store(self, session_id, metadata):
+        self.store_backend.store(session_id, metadata)
+        self._remember(session_id, metadata)
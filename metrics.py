@@ -0,0 +1,237 @@
+"""In-process stage timings, exported in the Prometheus text format.
+
+Wrap a stage of work in span() (or decorate a function with timed()) to
+record its duration, the bytes it processed and how far it pushed the
+process's peak RSS. Each stage feeds a histogram that render_prometheus()
+exposes; with a profile started on the current context, the spans of that
+request are also collected so they can be returned to the caller.
+
+    with span('load_audio') as stage:
+        audio_data = ...
+        stage.add_bytes(len(audio_data))
+
+Every process keeps its own counters, so with several gunicorn workers
+each scrape sees the worker that answered it.
+"""
+import bisect
+import contextvars
+import functools
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Upper bounds of the duration histogram buckets, in seconds
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_PREFIX = 'audiotracked'
+
+_lock = threading.Lock()
+_stages = {}
+_requests = {}
+_request_counts = {}
+_startup = {}
+# Spans of the request being profiled on this context, or None
+_profile = contextvars.ContextVar('profile', default=None)
+
+
+def _peak_rss():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError):
+        return None
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the shape Prometheus expects."""
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yield (upper bound label, observations at or below it)."""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield ('+Inf' if bound == float('inf') else repr(bound)), total
+
+
+class _StageStats:
+    def __init__(self):
+        self.seconds = Histogram()
+        self.bytes = 0
+        self.errors = 0
+        self.peak_rss_growth = 0
+
+
+class Span:
+    """One timed run of a stage; use through span()."""
+
+    __slots__ = ('name', 'nbytes', 'start', 'peak_rss')
+
+    def __init__(self, name, nbytes=0):
+        self.name = name
+        self.nbytes = nbytes
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.peak_rss = _peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        # Peak RSS is process-wide, so concurrent stages may share the growth
+        rss_growth = _peak_rss() - self.peak_rss
+        with _lock:
+            stats = _stages.get(self.name)
+            if stats is None:
+                stats = _stages[self.name] = _StageStats()
+            stats.seconds.observe(seconds)
+            stats.bytes += self.nbytes
+            stats.peak_rss_growth += rss_growth
+            if exc_type is not None:
+                stats.errors += 1
+        profile = _profile.get()
+        if profile is not None:
+            profile.append((self.name, seconds, self.nbytes, rss_growth))
+        return False
+
+
+def span(name, nbytes=0):
+    """Context manager timing one run of the stage called name."""
+    return Span(name, nbytes)
+
+
+def timed(name=None):
+    """Decorator timing every call of a function as a stage, named after it by default."""
+    def decorate(function):
+        stage = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def start_profile():
+    """Collect the spans run on this context until stop_profile(token)."""
+    return _profile.set([])
+
+
+def stop_profile(token):
+    """Stop collecting and return the (stage, seconds, bytes, rss growth) spans seen."""
+    spans = _profile.get()
+    _profile.reset(token)
+    return spans or []
+
+
+def summarize(spans):
+    """Total the spans of a profile per stage, in the order stages first ran."""
+    totals = {}
+    for name, seconds, nbytes, rss_growth in spans:
+        total = totals.setdefault(name, {"stage": name, "calls": 0, "seconds": 0.0, "bytes": 0, "peak_rss_growth_bytes": 0})
+        total["calls"] += 1
+        total["seconds"] += seconds
+        total["bytes"] += nbytes
+        total["peak_rss_growth_bytes"] += rss_growth
+    return list(totals.values())
+
+
+def observe_request(endpoint, status, seconds):
+    """Record one HTTP request against its endpoint."""
+    with _lock:
+        histogram = _requests.get(endpoint)
+        if histogram is None:
+            histogram = _requests[endpoint] = Histogram()
+        histogram.observe(seconds)
+        _request_counts[endpoint, status] = _request_counts.get((endpoint, status), 0) + 1
+
+
+def record_startup(phase, seconds):
+    """Record how long a startup phase took, such as importing the app."""
+    with _lock:
+        _startup[phase] = seconds
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(metric, labels, histogram):
+    for bound, count in histogram.cumulative():
+        yield f'{metric}_bucket{{{labels},le="{bound}"}} {count}'
+    yield f'{metric}_sum{{{labels}}} {histogram.sum!r}'
+    yield f'{metric}_count{{{labels}}} {histogram.count}'
+
+
+def render_prometheus():
+    """Return every metric in the Prometheus text exposition format (version 0.0.4)."""
+    prefix = METRIC_PREFIX
+    lines = [
+        f'# HELP {prefix}_stage_seconds Time spent in each processing stage.',
+        f'# TYPE {prefix}_stage_seconds histogram',
+    ]
+    with _lock:
+        stages = sorted(_stages.items())
+        for name, stats in stages:
+            lines.extend(_histogram_lines(f'{prefix}_stage_seconds', f'stage="{_label(name)}"', stats.seconds))
+        for metric, help_text, attribute in (
+            ('stage_bytes_total', 'Bytes processed by each stage.', 'bytes'),
+            ('stage_errors_total', 'Stage runs that raised an exception.', 'errors'),
+            ('stage_peak_rss_growth_bytes_total', 'Growth of the process peak RSS while each stage ran.', 'peak_rss_growth'),
+        ):
+            lines.append(f'# HELP {prefix}_{metric} {help_text}')
+            lines.append(f'# TYPE {prefix}_{metric} counter')
+            lines.extend(f'{prefix}_{metric}{{stage="{_label(name)}"}} {getattr(stats, attribute)}' for name, stats in stages)
+
+        lines.append(f'# HELP {prefix}_http_request_seconds Time to produce each HTTP response.')
+        lines.append(f'# TYPE {prefix}_http_request_seconds histogram')
+        for endpoint, histogram in sorted(_requests.items()):
+            lines.extend(_histogram_lines(f'{prefix}_http_request_seconds', f'endpoint="{_label(endpoint)}"', histogram))
+        lines.append(f'# HELP {prefix}_http_requests_total HTTP responses by endpoint and status.')
+        lines.append(f'# TYPE {prefix}_http_requests_total counter')
+        lines.extend(
+            f'{prefix}_http_requests_total{{endpoint="{_label(endpoint)}",status="{status}"}} {count}'
+            for (endpoint, status), count in sorted(_request_counts.items())
+        )
+
+    with _lock:
+        startup = sorted(_startup.items())
+    if startup:
+        lines.append(f'# HELP {prefix}_startup_seconds Time each startup phase took in this process or the master it was forked from.')
+        lines.append(f'# TYPE {prefix}_startup_seconds gauge')
+        lines.extend(f'{prefix}_startup_seconds{{phase="{_label(phase)}"}} {seconds!r}' for phase, seconds in startup)
+    lines.append(f'# HELP {prefix}_process_peak_rss_bytes Peak resident set size of this process.')
+    lines.append(f'# TYPE {prefix}_process_peak_rss_bytes gauge')
+    lines.append(f'{prefix}_process_peak_rss_bytes {_peak_rss()}')
+    rss = _current_rss()
+    if rss is not None:
+        lines.append(f'# HELP {prefix}_process_rss_bytes Current resident set size of this process.')
+        lines.append(f'# TYPE {prefix}_process_rss_bytes gauge')
+        lines.append(f'{prefix}_process_rss_bytes {rss}')
+    return '\n'.join(lines) + '\n'
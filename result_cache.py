@@ -0,0 +1,87 @@
+"""Content-addressed index of embed results, used by app.py to skip repeat work.
+
+An entry maps the hash of an embed request (its uploads, parameters and
+codec version) to the session that first produced the result and the key
+the result is stored under. Entries live in a metadata store, so every
+worker sharing that store shares the cache.
+"""
+import os
+import threading
+
+from metadata_store import LocalMetadataStore
+
+
+class ResultCache:
+    """Result index over any metadata store.
+
+    exists(s3_key) reports whether a result is still stored, so entries
+    whose result has since been deleted read as misses.
+    """
+
+    def __init__(self, entries, exists):
+        self.entries = entries
+        self.exists = exists
+
+    def get(self, key):
+        try:
+            entry = self.entries.load(key)
+        except KeyError:
+            return None
+        return entry if self.exists(entry['result_s3_key']) else None
+
+    def put(self, key, entry):
+        self.entries.store(key, entry)
+
+
+class LocalResultCache(ResultCache):
+    """Result index for local storage that keeps at most max_entries entries.
+
+    Only the index is bounded: results belong to the sessions that produced
+    them and are never deleted here. A hit refreshes the modification time
+    of its entry, and when a new entry pushes the count past max_entries
+    the least recently used entries are forgotten.
+    """
+
+    def __init__(self, entries_dir, storage_dir, max_entries):
+        super().__init__(LocalMetadataStore(entries_dir), self._exists)
+        self.entries_dir = entries_dir
+        self.storage_dir = storage_dir
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _exists(self, s3_key):
+        return os.path.exists(os.path.join(self.storage_dir, s3_key))
+
+    def _entry_path(self, name):
+        return os.path.join(self.entries_dir, name)
+
+    def get(self, key):
+        entry = super().get(key)
+        if entry is None:
+            return None
+        try:
+            os.utime(self._entry_path(f"{key}.json"))
+        except FileNotFoundError:
+            # Forgotten by another worker since it was read
+            pass
+        return entry
+
+    def put(self, key, entry):
+        super().put(key, entry)
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        cached = []
+        for name in os.listdir(self.entries_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                cached.append((os.stat(self._entry_path(name)).st_mtime_ns, name))
+            except FileNotFoundError:
+                continue
+        for _, name in sorted(cached)[:max(len(cached) - self.max_entries, 0)]:
+            try:
+                os.remove(self._entry_path(name))
+            except FileNotFoundError:
+                pass
@@ -82,7 +82,7 @@ sleep 10
 sudo docker-compose down || true
 
 # Create necessary directories
-mkdir -p files temp_uploads
+mkdir -p files
 
 # Set environment variables for Docker
 export AWS_ACCESS_KEY_ID=\$(aws configure get aws_access_key_id)
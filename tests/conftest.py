@@ -0,0 +1,45 @@
+import os
+import sys
+import wave
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_wav(path, num_channels=2, sample_width=2, num_frames=64000, frame_rate=16000, seed=0):
+    """Write a WAV of random samples and return its path."""
+    samples = np.random.default_rng(seed).integers(0, 256, num_frames * num_channels * sample_width, dtype=np.uint8)
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(num_channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(frame_rate)
+        wav_file.writeframes(samples.tobytes())
+    return str(path)
+
+
+def read_frames(path):
+    with wave.open(str(path), 'rb') as wav_file:
+        return wav_file.getparams(), wav_file.readframes(wav_file.getnframes())
+
+
+@pytest.fixture
+def host(tmp_path):
+    """Two seconds of 16-bit stereo noise: 16000 bytes of sample-codec capacity."""
+    return write_wav(tmp_path / 'host.wav')
+
+
+@pytest.fixture
+def watermark(tmp_path):
+    return write_wav(tmp_path / 'watermark.wav', num_channels=1, sample_width=1, num_frames=800, frame_rate=8000, seed=1)
+
+
+@pytest.fixture
+def image(tmp_path):
+    """A 32x32 greyscale gradient, which survives JPEG output closely."""
+    path = tmp_path / 'image.png'
+    gradient = np.add.outer(np.arange(32), np.arange(32)).astype(np.uint8) * 4
+    Image.fromarray(gradient, mode='L').save(path)
+    return str(path)
@@ -0,0 +1,160 @@
+import importlib
+import io
+import os
+import sys
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+from conftest import write_wav
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    root = tmp_path_factory.mktemp('app')
+    environ = {
+        'DISABLE_S3': '1',
+        'LOCAL_STORAGE_DIR': str(root / 'local_storage'),
+        'FILES_DIR': str(root / 'files'),
+        'METADATA_BACKEND': 'local',
+    }
+    saved = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    sys.modules.pop('app', None)
+    try:
+        yield importlib.import_module('app')
+    finally:
+        sys.modules.pop('app', None)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def host_bytes(tmp_path):
+    with open(write_wav(tmp_path / 'host.wav', seed=int(time.time_ns() % 1000)), 'rb') as host:
+        return host.read()
+
+
+def _post(client, path, query='', **fields):
+    data = {name: (io.BytesIO(value), f'{name}.wav') if isinstance(value, bytes) else value
+            for name, value in fields.items()}
+    return client.post(path + query, data=data, content_type='multipart/form-data')
+
+
+def _path(url):
+    return urlparse(url).path
+
+
+def _wait(client, status_url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(status_url).get_json()
+        if job['status'] in ('completed', 'failed'):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'job did not finish: {job}')
+
+
+def test_text_round_trip_and_cache_hit(client, host_bytes):
+    first = _post(client, '/api/text-watermark', audio=host_bytes, text='hello').get_json()
+    assert first['success'] and 'cached' not in first
+    carrier = client.get(_path(first['result_url'])).data
+    extracted = _post(client, '/api/text-watermark/extract', audio=carrier).get_json()
+    assert extracted['extracted_text'] == 'hello'
+
+    repeat = _post(client, '/api/text-watermark', audio=host_bytes, text='hello').get_json()
+    assert repeat['cached'] and repeat['session_id'] == first['session_id']
+    other = _post(client, '/api/text-watermark', audio=host_bytes, text='hello', compression='zlib').get_json()
+    assert 'cached' not in other and other['session_id'] != first['session_id']
+
+
+@pytest.mark.parametrize('compression', ['brotli', 'png'])
+def test_unsupported_compression_is_a_client_error(client, host_bytes, compression):
+    response = _post(client, '/api/text-watermark', audio=host_bytes, text='hello', compression=compression)
+    assert response.status_code == 400
+    response = _post(client, '/api/text-watermark/batch', audio=host_bytes, text=['a'], compression=compression)
+    assert response.status_code == 400
+
+
+def test_batch_publishes_every_text(client, host_bytes):
+    response = _post(client, '/api/text-watermark/batch', audio=host_bytes, text=['one', 'two', 'three'])
+    results = response.get_json()['results']
+    assert [item['text'] for item in results] == ['one', 'two', 'three']
+    for item in results:
+        carrier = client.get(_path(item['result_url'])).data
+        assert _post(client, '/api/text-watermark/extract', audio=carrier).get_json()['extracted_text'] == item['text']
+
+    again = _post(client, '/api/text-watermark/batch', audio=host_bytes, text=['two', 'four']).get_json()['results']
+    assert again[0]['cached'] and again[0]['session_id'] == results[1]['session_id']
+    assert 'cached' not in again[1]
+
+
+def test_job_moves_from_queued_to_completed(client, host_bytes):
+    response = _post(client, '/api/text-watermark', query='?async=1', audio=host_bytes, text='queued')
+    assert response.status_code == 202
+    queued = response.get_json()
+    assert queued['status'] == 'queued'
+    job = _wait(client, queued['status_url'])
+    assert job['status'] == 'completed' and job['progress'] == 1.0
+    assert job['result']['session_id'] == queued['job_id']
+
+
+def test_failed_job_reports_its_error(client):
+    response = _post(client, '/api/text-watermark', query='?async=1', audio=b'not a wav', text='x')
+    job = _wait(client, response.get_json()['status_url'])
+    assert job['status'] == 'failed' and job['error']
+
+
+def test_failed_queueing_releases_the_job_slot(app_module, client, host_bytes, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(app_module, '_store_metadata', fail)
+    for _ in range(app_module.JOB_QUEUE_LIMIT + 1):
+        response = _post(client, '/api/text-watermark', query='?async=1', audio=host_bytes, text='x')
+        assert response.status_code == 500
+    monkeypatch.undo()
+    response = _post(client, '/api/text-watermark', query='?async=1', audio=host_bytes, text='x')
+    assert response.status_code == 202
+    _wait(client, response.get_json()['status_url'])
+
+
+def test_result_download_supports_range_and_etag(client, host_bytes):
+    result = _post(client, '/api/text-watermark', audio=host_bytes, text='ranges').get_json()
+    url = _path(result['result_url'])
+    full = client.get(url)
+    assert full.status_code == 200
+    cache_control = full.headers['Cache-Control']
+    assert 'private' in cache_control and 'immutable' in cache_control and 'public' not in cache_control
+
+    partial = client.get(url, headers={'Range': 'bytes=10-19'})
+    assert partial.status_code == 206 and partial.data == full.data[10:20]
+    assert client.get(url, headers={'If-None-Match': full.headers['ETag']}).status_code == 304
+    stale = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert stale.status_code == 200 and stale.data == full.data
+
+    name = url.rsplit('/', 1)[1]
+    download = client.get(f'/api/download/{name}', headers={'Range': 'bytes=0-3'})
+    assert download.status_code == 206 and download.data == b'RIFF'
+
+
+@pytest.mark.parametrize('path', [
+    'metadata',
+    'result-cache',
+    'text_watermarked/../metadata',
+    'text_watermarked',
+])
+def test_local_file_serves_only_session_outputs(app_module, client, path):
+    os.makedirs(os.path.join(app_module.LOCAL_STORAGE_DIR, 'metadata'), exist_ok=True)
+    with open(os.path.join(app_module.LOCAL_STORAGE_DIR, 'metadata', 'secret.json'), 'w') as secret:
+        secret.write('{}')
+    target = path if path == 'text_watermarked' else f'{path}/secret.json'
+    assert client.get(f'/api/local-file/{target}').status_code == 404
@@ -0,0 +1,21 @@
+import json
+
+import cli
+
+
+def test_embed_then_extract_text(tmp_path, host, capsys):
+    assert cli.main(['embed-text', host, '--text', 'from the cli', '-o', str(tmp_path / 'embedded'), '-j', '1']) == 0
+    capsys.readouterr()
+    assert cli.main(['extract-text', str(tmp_path / 'embedded'), '-o', str(tmp_path / 'extracted'), '-j', '1', '--json']) == 0
+    reports = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert reports[-2]["text"] == 'from the cli'
+    assert reports[-1]["summary"]["failed"] == 0
+
+
+def test_missing_manifest_path_fails_only_its_item(tmp_path, host):
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text(f'{host}\n{tmp_path / "missing.wav"}\n')
+    reports = cli.run_batch('extract-text', cli.collect_inputs([], [str(manifest)]), str(tmp_path / 'out'), {}, workers=1)
+    assert sorted(report["ok"] for report in reports) == [False, True]
+    missing = next(report for report in reports if not report["ok"])
+    assert missing["bytes"] == 0 and missing["error"]
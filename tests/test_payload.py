@@ -0,0 +1,230 @@
+import io
+import lzma
+import struct
+import tracemalloc
+import wave
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+from conftest import read_frames
+
+CORRUPTED = 'truncated or corrupted'
+
+
+def _forge_carrier(tmp_path, host, payload_type, stored, flags=0, **params):
+    """Embed stored bytes behind a header whose fields are taken at face value."""
+    audio_data, num_channels, sample_width, frame_rate = utils.load_audio(host)
+    flags |= utils._layout_flags(utils.CODEC_SAMPLE, None)
+    header = utils._pack_header(payload_type, len(stored), zlib.crc32(stored), flags=flags, **params)
+    carrier = utils._carrier(audio_data, num_channels, sample_width, utils.CODEC_SAMPLE, None)
+    utils._embed_bits(carrier, utils._payload_bits(header + stored))
+    output = str(tmp_path / 'forged.wav')
+    utils.save_audio(output, audio_data, num_channels, sample_width, frame_rate)
+    return output
+
+
+def _compressed(compression, raw_length, body):
+    flag = utils._COMPRESSION_FLAGS[compression]
+    return utils._RAW_LENGTH.pack(raw_length) + body, flag
+
+
+@pytest.mark.parametrize('compression', [utils.COMPRESSION_ZLIB, utils.COMPRESSION_LZMA])
+def test_compressed_text_round_trip(tmp_path, host, compression):
+    message = 'a highly repetitive message ' * 2000
+    output = str(tmp_path / 'out.wav')
+    # Far larger than the 16000 bytes the host can carry uncompressed
+    utils.text_watermark(message, host, output=output, compression=compression)
+    assert utils.extract_text_watermark(output) == message
+    assert utils.extract_text_watermark_stream(output) == message
+
+
+@pytest.mark.parametrize('compression', [utils.COMPRESSION_ZLIB, utils.COMPRESSION_LZMA])
+def test_compressed_audio_round_trip(tmp_path, host, watermark, compression):
+    output, extracted = str(tmp_path / 'out.wav'), str(tmp_path / 'extracted.wav')
+    digest = utils.audio_watermark(host, watermark, output=output, compression=compression)
+    assert utils.extract_audio_watermark(output, digest, output=extracted)
+    assert read_frames(extracted) == read_frames(watermark)
+    utils.audio_watermark_stream(host, watermark, output, chunk_frames=1024, compression=compression)
+    assert utils.extract_audio_watermark_direct_stream(output, extracted, chunk_frames=1024) == 800
+    assert read_frames(extracted) == read_frames(watermark)
+
+
+@pytest.mark.parametrize('compression', [utils.COMPRESSION_ZLIB, utils.COMPRESSION_PNG])
+def test_compressed_image_round_trip(tmp_path, host, image, compression):
+    output, extracted = str(tmp_path / 'out.wav'), str(tmp_path / 'extracted.jpg')
+    width, height, bits = utils.image_watermark(host, image, output=output, compression=compression)
+    assert (width, height) == (32, 32) and bits < 32 * 32 * 8
+    assert utils.extract_image_watermark_direct(output, output=extracted)[:2] == (32, 32)
+    original = np.asarray(Image.open(image), dtype=np.int16)
+    assert np.abs(original - np.asarray(Image.open(extracted), dtype=np.int16)).mean() < 4
+
+
+def test_compression_options_are_validated(tmp_path, host):
+    output = str(tmp_path / 'out.wav')
+    with pytest.raises(ValueError, match='Unknown compression'):
+        utils.text_watermark('x', host, output=output, compression='brotli')
+    with pytest.raises(ValueError, match='payload header'):
+        utils.text_watermark('x', host, header=False, output=output, compression=utils.COMPRESSION_ZLIB)
+    with pytest.raises(ValueError, match='image payloads'):
+        utils.text_watermark('x', host, output=output, compression=utils.COMPRESSION_PNG)
+
+
+@pytest.mark.parametrize('compression, expand', [
+    (utils.COMPRESSION_ZLIB, zlib.compress),
+    (utils.COMPRESSION_LZMA, lzma.compress),
+])
+def test_payload_expanding_past_its_length_is_rejected(tmp_path, host, compression, expand):
+    # 8 MB of zeros shrinks to a few KB but claims to unpack to 10 bytes
+    stored, flag = _compressed(compression, 10, expand(bytes(8 << 20)))
+    forged = _forge_carrier(tmp_path, host, utils.PAYLOAD_TEXT, stored, flag)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_text_watermark(forged)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_text_watermark_stream(forged)
+
+
+def test_decompression_stops_just_past_the_claimed_length(tmp_path, host, monkeypatch):
+    outputs = []
+
+    class Spy:
+        def __init__(self, compression):
+            self.decompressor = real(compression)
+
+        def decompress(self, *args):
+            raw = self.decompressor.decompress(*args)
+            outputs.append(len(raw))
+            return raw
+
+        def flush(self):
+            return self.decompressor.flush()
+
+    real = utils._decompressor
+    monkeypatch.setattr(utils, '_decompressor', Spy)
+    stored, flag = _compressed(utils.COMPRESSION_ZLIB, 10, zlib.compress(bytes(8 << 20)))
+    forged = _forge_carrier(tmp_path, host, utils.PAYLOAD_TEXT, stored, flag)
+    for extract in (utils.extract_text_watermark, utils.extract_text_watermark_stream):
+        with pytest.raises(ValueError, match=CORRUPTED):
+            extract(forged)
+    assert outputs and max(outputs) <= 11
+
+
+def test_payload_claiming_more_than_the_host_is_rejected(tmp_path, host):
+    stored, flag = _compressed(utils.COMPRESSION_ZLIB, 0xFFFFFFF0, zlib.compress(b'tiny'))
+    forged = _forge_carrier(tmp_path, host, utils.PAYLOAD_TEXT, stored, flag)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_text_watermark(forged)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_text_watermark_stream(forged)
+
+
+def test_streamed_audio_expanding_past_its_length_is_rejected(tmp_path, host):
+    stored, flag = _compressed(utils.COMPRESSION_ZLIB, 1000, zlib.compress(bytes(8 << 20)))
+    forged = _forge_carrier(tmp_path, host, utils.PAYLOAD_AUDIO, stored, flag,
+                            num_channels=1, sample_width=1, frame_rate=8000)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_audio_watermark_direct_stream(forged, str(tmp_path / 'extracted.wav'))
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_audio_watermark_direct(forged, output=str(tmp_path / 'extracted.wav'))
+
+
+def test_png_payload_must_match_header_dimensions(tmp_path, host, image):
+    with open(image, 'rb') as png:
+        stored, flag = _compressed(utils.COMPRESSION_PNG, 64 * 64, png.read())
+    forged = _forge_carrier(tmp_path, host, utils.PAYLOAD_IMAGE, stored, flag,
+                            width=64, height=64, num_channels=1, sample_width=1)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_image_watermark_direct(forged, output=str(tmp_path / 'extracted.jpg'))
+
+
+def test_undecodable_compressed_payload_is_rejected(tmp_path, host):
+    stored, flag = _compressed(utils.COMPRESSION_ZLIB, 10, b'not zlib at all')
+    forged = _forge_carrier(tmp_path, host, utils.PAYLOAD_TEXT, stored, flag)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_text_watermark(forged)
+
+
+def _wav_bytes(data_chunk_size, body, chunks=b''):
+    fmt = struct.pack('<HHIIHH', utils.WAVE_FORMAT_PCM, 2, 44100, 44100 * 4, 4, 16)
+    return (b'RIFF' + struct.pack('<I', 36 + len(body)) + b'WAVE' + chunks
+            + b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+            + b'data' + struct.pack('<I', data_chunk_size) + body)
+
+
+class _Pipe(io.RawIOBase):
+    """A non-seekable upload stream."""
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        block = self.data.read(len(buffer))
+        buffer[:len(block)] = block
+        return len(block)
+
+
+@pytest.mark.parametrize('wrap', [io.BytesIO, lambda data: io.BufferedReader(_Pipe(data))])
+def test_load_audio_ignores_an_oversized_data_chunk(wrap):
+    # The header claims 1 GiB of samples; only 90 bytes follow it
+    wav = _wav_bytes(0x40000000, bytes(range(90)))
+    tracemalloc.start()
+    try:
+        audio_data, num_channels, sample_width, _ = utils.load_audio(wrap(wav))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert (num_channels, sample_width) == (2, 2)
+    # Whole frames only
+    assert audio_data.tobytes() == bytes(range(88))
+    # One read block at most, nowhere near the 1 GiB the header claims
+    assert peak < 4 << 20
+
+
+@pytest.mark.parametrize('wav', [
+    b'RIFX' + bytes(40),
+    b'RIFF' + struct.pack('<I', 4) + b'WAVE',
+    b'RIFF' + struct.pack('<I', 12) + b'WAVE' + b'data' + struct.pack('<I', 0),
+])
+def test_load_audio_rejects_malformed_headers(wav):
+    with pytest.raises(wave.Error):
+        utils.load_audio(io.BytesIO(wav))
+
+
+def test_unsupported_header_version_is_rejected(tmp_path, host):
+    output = str(tmp_path / 'out.wav')
+    utils.text_watermark('hello', host, output=output)
+    audio_data, num_channels, sample_width, frame_rate = utils.load_audio(output)
+    carrier = utils._carrier(audio_data, num_channels, sample_width, utils.CODEC_SAMPLE, None)
+    header = bytearray(np.packbits(carrier[:utils.HEADER_BYTES * 8] & 1).tobytes())
+    header[4] = utils.PAYLOAD_VERSION + 1
+    utils._embed_bits(carrier, utils._payload_bits(bytes(header)))
+    with pytest.raises(ValueError, match='Unsupported watermark header version'):
+        utils.read_payload_header(carrier)
+
+
+def test_payload_failing_its_checksum_is_rejected(tmp_path, host):
+    stored = b'hello'
+    audio_data, num_channels, sample_width, frame_rate = utils.load_audio(host)
+    header = utils._pack_header(utils.PAYLOAD_TEXT, len(stored), zlib.crc32(stored) ^ 1,
+                                flags=utils._layout_flags(utils.CODEC_SAMPLE, None))
+    carrier = utils._carrier(audio_data, num_channels, sample_width, utils.CODEC_SAMPLE, None)
+    utils._embed_bits(carrier, utils._payload_bits(header + stored))
+    output = str(tmp_path / 'out.wav')
+    utils.save_audio(output, audio_data, num_channels, sample_width, frame_rate)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_text_watermark(output)
+    with pytest.raises(ValueError, match=CORRUPTED):
+        utils.extract_text_watermark_stream(output)
+
+
+def test_payload_of_another_type_is_rejected(tmp_path, host, watermark):
+    output = str(tmp_path / 'out.wav')
+    utils.audio_watermark(host, watermark, output=output)
+    with pytest.raises(ValueError, match='expected'):
+        utils.extract_text_watermark(output)
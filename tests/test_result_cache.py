@@ -0,0 +1,70 @@
+import os
+
+from metadata_store import LocalMetadataStore
+from result_cache import LocalResultCache, ResultCache
+
+
+def _store_result(storage_dir, s3_key, size=100):
+    path = os.path.join(storage_dir, s3_key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as result:
+        result.write(bytes(size))
+    return path
+
+
+def _cache(tmp_path, max_entries=10):
+    storage_dir = str(tmp_path / 'storage')
+    return LocalResultCache(os.path.join(storage_dir, 'result-cache'), storage_dir, max_entries), storage_dir
+
+
+def test_hit_and_miss(tmp_path):
+    cache, storage_dir = _cache(tmp_path)
+    _store_result(storage_dir, 'text_watermarked/a_result.wav')
+    assert cache.get('key') is None
+    cache.put('key', {"session_id": "a", "result_s3_key": 'text_watermarked/a_result.wav'})
+    assert cache.get('key') == {"session_id": "a", "result_s3_key": 'text_watermarked/a_result.wav'}
+    assert cache.get('other') is None
+
+
+def test_entry_whose_result_is_gone_misses(tmp_path):
+    cache, storage_dir = _cache(tmp_path)
+    path = _store_result(storage_dir, 'watermarked/a_result.wav')
+    cache.put('key', {"session_id": "a", "result_s3_key": 'watermarked/a_result.wav'})
+    os.remove(path)
+    assert cache.get('key') is None
+
+
+def test_hit_leaves_the_result_untouched(tmp_path):
+    cache, storage_dir = _cache(tmp_path)
+    path = _store_result(storage_dir, 'watermarked/a_result.wav')
+    os.utime(path, (1000, 1000))
+    cache.put('key', {"session_id": "a", "result_s3_key": 'watermarked/a_result.wav'})
+    assert cache.get('key') is not None
+    # Served files derive their ETag and Last-Modified from the mtime
+    assert os.stat(path).st_mtime == 1000
+
+
+def test_index_forgets_least_recently_used_but_keeps_results(tmp_path):
+    cache, storage_dir = _cache(tmp_path, max_entries=2)
+    paths = {}
+    for name in ('a', 'b'):
+        paths[name] = _store_result(storage_dir, f'watermarked/{name}_result.wav')
+        cache.put(name, {"session_id": name, "result_s3_key": f'watermarked/{name}_result.wav'})
+        os.utime(os.path.join(cache.entries_dir, f'{name}.json'), (1000 + ord(name), 1000 + ord(name)))
+    # A hit on a makes b the least recently used
+    assert cache.get('a') is not None
+    paths['c'] = _store_result(storage_dir, 'watermarked/c_result.wav')
+    cache.put('c', {"session_id": "c", "result_s3_key": 'watermarked/c_result.wav'})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    # Results belong to their sessions and are never deleted by the cache
+    assert all(os.path.exists(path) for path in paths.values())
+
+
+def test_result_cache_over_any_store(tmp_path):
+    stored = {'watermarked/a_result.wav'}
+    cache = ResultCache(LocalMetadataStore(str(tmp_path / 'entries')), stored.__contains__)
+    cache.put('key', {"session_id": "a", "result_s3_key": 'watermarked/a_result.wav'})
+    assert cache.get('key')["session_id"] == "a"
+    stored.clear()
+    assert cache.get('key') is None
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+from conftest import read_frames
+
+# (codec, channel) layouts a headered payload can be written with
+LAYOUTS = [
+    (utils.CODEC_SAMPLE, None),
+    (utils.CODEC_BYTE, None),
+    (utils.CODEC_SAMPLE, 0),
+    (utils.CODEC_SAMPLE, 1),
+]
+MESSAGE = 'Ünïcode survives the header, plain ASCII the legacy layout'
+
+
+def _high_bits_changed(host, output):
+    """Count bytes of output that differ from host above their LSB."""
+    _, original = read_frames(host)
+    _, written = read_frames(output)
+    original = np.frombuffer(original, dtype=np.uint8)
+    written = np.frombuffer(written, dtype=np.uint8)
+    return int(np.count_nonzero((original ^ written) & 0xFE))
+
+
+@pytest.mark.parametrize('codec, channel', LAYOUTS)
+def test_text_round_trip(tmp_path, host, codec, channel):
+    output = str(tmp_path / 'out.wav')
+    utils.text_watermark(MESSAGE, host, output=output, codec=codec, channel=channel)
+    assert utils.extract_text_watermark(output) == MESSAGE
+    assert utils.extract_text_watermark_stream(output) == MESSAGE
+    assert _high_bits_changed(host, output) == 0
+
+
+@pytest.mark.parametrize('codec, channel', LAYOUTS)
+def test_text_stream_round_trip(tmp_path, host, codec, channel):
+    output = str(tmp_path / 'out.wav')
+    utils.text_watermark_stream(MESSAGE, host, output, chunk_frames=1024, codec=codec, channel=channel)
+    assert utils.extract_text_watermark(output) == MESSAGE
+    assert utils.extract_text_watermark_stream(output, chunk_frames=1024) == MESSAGE
+
+
+def test_headerless_text_round_trip(tmp_path, host):
+    output = str(tmp_path / 'out.wav')
+    utils.text_watermark('legacy message', host, header=False, output=output)
+    assert utils.read_payload_header(utils.load_audio(output)[0]) is None
+    assert utils.extract_text_watermark(output) == 'legacy message'
+    assert utils.extract_text_watermark_stream(output) == 'legacy message'
+
+
+def test_text_batch_matches_single_embeds(tmp_path, host):
+    outputs = [str(tmp_path / f'out{index}.wav') for index in range(3)]
+    written = []
+    utils.text_watermark_batch(['one', 'two', 'three'], host, outputs, max_workers=2,
+                               on_output=lambda index, bits: written.append(index))
+    assert sorted(written) == [0, 1, 2]
+    assert [utils.extract_text_watermark(output) for output in outputs] == ['one', 'two', 'three']
+    single = str(tmp_path / 'single.wav')
+    utils.text_watermark('two', host, output=single)
+    assert read_frames(single) == read_frames(outputs[1])
+
+
+@pytest.mark.parametrize('codec, channel', LAYOUTS)
+def test_audio_round_trip(tmp_path, host, watermark, codec, channel):
+    output, extracted = str(tmp_path / 'out.wav'), str(tmp_path / 'extracted.wav')
+    digest = utils.audio_watermark(host, watermark, output=output, codec=codec, channel=channel)
+    assert utils.extract_audio_watermark(output, digest, output=extracted)
+    assert read_frames(extracted) == read_frames(watermark)
+    assert utils.extract_audio_watermark_direct(output, output=extracted) == 800
+    assert read_frames(extracted) == read_frames(watermark)
+
+
+@pytest.mark.parametrize('codec, channel', LAYOUTS)
+def test_audio_stream_round_trip(tmp_path, host, watermark, codec, channel):
+    output, extracted = str(tmp_path / 'out.wav'), str(tmp_path / 'extracted.wav')
+    utils.audio_watermark_stream(host, watermark, output, chunk_frames=1024, codec=codec, channel=channel)
+    assert utils.extract_audio_watermark_direct_stream(output, extracted, chunk_frames=1024) == 800
+    assert read_frames(extracted) == read_frames(watermark)
+
+
+def test_headerless_audio_needs_the_digest(tmp_path, host, watermark):
+    output, extracted = str(tmp_path / 'out.wav'), str(tmp_path / 'extracted.wav')
+    digest = utils.audio_watermark(host, watermark, header=False, output=output)
+    assert utils.extract_audio_watermark(output, digest, output=extracted)
+    # Without a header the format of the hidden audio is unknown, only its bytes
+    assert read_frames(extracted)[1] == read_frames(watermark)[1]
+    assert not utils.extract_audio_watermark(output, utils.watermark_digest(b'other'), output=extracted)
+
+
+@pytest.mark.parametrize('codec, channel', LAYOUTS)
+def test_image_round_trip(tmp_path, host, image, codec, channel):
+    output, extracted = str(tmp_path / 'out.wav'), str(tmp_path / 'extracted.jpg')
+    assert utils.image_watermark(host, image, output=output, codec=codec, channel=channel) == (32, 32, 32 * 32 * 8)
+    assert utils.extract_image_watermark_direct(output, output=extracted)[:2] == (32, 32)
+    # The extracted image is saved as JPEG, so compare loosely
+    original = np.asarray(Image.open(image), dtype=np.int16)
+    recovered = np.asarray(Image.open(extracted), dtype=np.int16)
+    assert np.abs(original - recovered).mean() < 4
+
+
+def test_payload_too_large_for_host(tmp_path, host):
+    with pytest.raises(ValueError):
+        utils.text_watermark('x' * 20000, host, output=str(tmp_path / 'out.wav'))
+
+
+@pytest.mark.parametrize('codec, channel', [(utils.CODEC_SAMPLE, None), (None, 0)])
+def test_headerless_embed_needs_the_byte_layout(tmp_path, host, codec, channel):
+    with pytest.raises(ValueError):
+        utils.text_watermark('x', host, header=False, output=str(tmp_path / 'out.wav'), codec=codec, channel=channel)
+
+
+def test_capacity_matches_layout(host):
+    assert utils.watermark_capacity(host)['capacity_samples'] == 64000 * 2
+    assert utils.watermark_capacity(host, codec=utils.CODEC_BYTE)['capacity_samples'] == 64000 * 4
+    single = utils.watermark_capacity(host, text='hello', channel=1)
+    assert single['capacity_samples'] == 64000
+    assert single['payload_bytes'] == 5 and single['fits']
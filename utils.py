@@ -1,236 +1,1124 @@
 import wave
 import numpy as np
 import os
+import struct
+import hashlib
+import io
+import lzma
+import tempfile
+import uuid
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
 from PIL import Image
 
+from metrics import span
+
 FILES_DIR = os.getenv("FILES_DIR", "files")
 os.makedirs(FILES_DIR, exist_ok=True)
 
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+TEXT_TERMINATOR = '#####'
+TEXT_BLOCK_BYTES = 4096
+STREAM_CHUNK_FRAMES = int(os.getenv("STREAM_CHUNK_FRAMES", "65536"))
+# Threads used to split bit expansion, embedding and extraction of one
+# buffer; ranges smaller than PARALLEL_MIN_BYTES are not worth a thread
+PARALLEL_WORKERS = int(os.getenv("PARALLEL_WORKERS", "1"))
+PARALLEL_MIN_BYTES = int(os.getenv("PARALLEL_MIN_BYTES", str(1 << 20)))
+
+# Self-describing payload header written ahead of every embedded payload
+PAYLOAD_MAGIC = b'ATWM'
+PAYLOAD_VERSION = 1
+PAYLOAD_TEXT = 1
+PAYLOAD_AUDIO = 2
+PAYLOAD_IMAGE = 3
+_HEADER_FORMAT = struct.Struct('<4sBBHIIIHHII')
+HEADER_BYTES = _HEADER_FORMAT.size
+
+# Carrier layouts: bit 0 of every sample byte (legacy), or bit 0 of every
+# PCM sample. The layout used is recorded in the header flags; a single
+# carrier channel is stored in the high byte of the flags.
+CODEC_BYTE = 'byte'
+CODEC_SAMPLE = 'sample'
+FLAG_SAMPLE_LSB = 0x0001
+FLAG_SINGLE_CHANNEL = 0x0002
+
+# Optional compression of the payload before bit expansion, recorded in the
+# header flags. Compressed payloads start with their uncompressed length.
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_LZMA = 'lzma'
+COMPRESSION_PNG = 'png'
+_COMPRESSION_FLAGS = {COMPRESSION_ZLIB: 0x0004, COMPRESSION_LZMA: 0x0008, COMPRESSION_PNG: 0x0010}
+_RAW_LENGTH = struct.Struct('<I')
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(16 << 20)))
+
+# Common image sizes searched for headerless image payloads, most common first
+IMAGE_DIMENSIONS = [
+    (500, 375), (640, 480), (800, 600), (400, 300), (320, 240),
+    (256, 256), (128, 128), (512, 512), (64, 64),
+    (100, 80), (120, 90), (150, 100), (200, 150), (300, 200),
+    (80, 100), (90, 120), (100, 150), (150, 200), (240, 320),
+    (300, 400), (480, 640), (600, 800),
+]
+# Rows past a candidate image compared against the rows inside it
+IMAGE_MARGIN_ROWS = 16
+# Scores below IMAGE_MIN_SCORE are not an image; within IMAGE_SCORE_TOLERANCE
+# of the best score the larger candidate wins, since flat image regions
+# (margins, backgrounds) also look smooth at smaller sizes
+IMAGE_MIN_SCORE = 0.25
+IMAGE_SCORE_TOLERANCE = 0.1
+# Mean absolute difference of two independent uniform random bytes
+_RANDOM_BYTE_DIFF = 255 * 257 / 768
+
+PayloadHeader = namedtuple(
+    'PayloadHeader',
+    'payload_type flags length width height num_channels sample_width frame_rate checksum',
+)
+
 def _resolve_input_path(path):
     if os.path.isabs(path) or os.path.exists(path):
         return path
     return os.path.join(FILES_DIR, path)
 
 def _resolve_output_path(path):
-    if os.path.isabs(path) or path.startswith(f"{FILES_DIR}/"):
+    # Bare filenames land in FILES_DIR; anything with a directory is used as given
+    if os.path.isabs(path) or os.path.dirname(path):
         return path
     return os.path.join(FILES_DIR, path)
 
+def _read_wav_header(wav_file, file_size=None):
+    """Walk the RIFF chunks of a PCM WAV file object up to its sample data.
+
+    Leaves wav_file positioned at the first sample byte and returns
+    (num_channels, sample_width, frame_rate, data_offset, data_size).
+    """
+    riff = wav_file.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise wave.Error('file does not start with RIFF/WAVE header')
+    data_offset = 12
+    fmt = None
+    while True:
+        chunk_header = wav_file.read(8)
+        if len(chunk_header) < 8:
+            raise wave.Error('fmt chunk and/or data chunk missing')
+        data_offset += 8
+        chunk_id = chunk_header[:4]
+        chunk_size = struct.unpack('<I', chunk_header[4:])[0]
+        if chunk_id == b'data':
+            if fmt is None:
+                raise wave.Error('data chunk before fmt chunk')
+            break
+        # Chunks ahead of the sample data are small, so read rather than seek
+        # to keep non-seekable upload streams working
+        chunk = wav_file.read(chunk_size + chunk_size % 2)
+        data_offset += len(chunk)
+        if chunk_id == b'fmt ':
+            fmt = chunk[:chunk_size]
+            if len(fmt) < 16:
+                raise wave.Error('fmt chunk too short')
+
+    format_tag, num_channels, frame_rate, _, _, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE):
+        raise wave.Error(f'unknown format: {format_tag}')
+    sample_width = (bits_per_sample + 7) // 8
+    if not num_channels or not sample_width:
+        raise wave.Error('bad sample format')
+    frame_size = num_channels * sample_width
+    data_size = chunk_size
+    if file_size is not None:
+        data_size = min(data_size, file_size - data_offset)
+    data_size -= data_size % frame_size
+    return num_channels, sample_width, frame_rate, data_offset, data_size
+
+def _read_wav_info(source):
+    """Return (num_channels, sample_width, frame_rate, data_size) from the header alone.
+
+    source may be a path, the bytes of a WAV file or a readable file object;
+    none of its sample data is read. A file object only needs to hold the
+    header, so a client can send the first few kilobytes of a large host.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        num_channels, sample_width, frame_rate, _, data_size = _read_wav_header(io.BytesIO(source), len(source) or None)
+    elif not isinstance(source, (str, os.PathLike)):
+        num_channels, sample_width, frame_rate, _, data_size = _read_wav_header(source)
+    else:
+        with open(_resolve_input_path(os.fspath(source)), 'rb') as wav_file:
+            file_size = os.fstat(wav_file.fileno()).st_size
+            num_channels, sample_width, frame_rate, _, data_size = _read_wav_header(wav_file, file_size)
+    return num_channels, sample_width, frame_rate, data_size
+
+def _remaining_bytes(stream):
+    """Bytes left after the current position of a seekable stream, else None."""
+    try:
+        if not stream.seekable():
+            return None
+        position = stream.tell()
+        end = stream.seek(0, io.SEEK_END)
+        stream.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return end - position
+
+def _read_sample_data(wav_file, data_size, frame_size):
+    """Read sample data from a file object into a writable uint8 array.
+
+    data_size comes from the upload's own header, so it is only trusted as
+    an upper bound: a seekable stream is capped at what it really holds, and
+    anything else grows its buffer as the bytes arrive.
+    """
+    remaining = _remaining_bytes(wav_file)
+    if remaining is None:
+        audio_data = bytearray()
+        while len(audio_data) < data_size:
+            block = wav_file.read(min(data_size - len(audio_data), 1 << 20))
+            if not block:
+                break
+            audio_data += block
+        filled = len(audio_data)
+    else:
+        audio_data = bytearray(min(data_size, remaining))
+        view = memoryview(audio_data)
+        filled = 0
+        while filled < len(audio_data):
+            block = wav_file.read(min(len(audio_data) - filled, 1 << 20))
+            if not block:
+                break
+            view[filled:filled + len(block)] = block
+            filled += len(block)
+        view.release()
+    # A truncated upload keeps only its whole frames
+    del audio_data[filled - filled % frame_size:]
+    return np.frombuffer(audio_data, dtype=np.uint8)
+
 def load_audio(filename):
-    filepath = _resolve_input_path(filename)
-    with wave.open(filepath, 'rb') as audio_file:
-        num_channels = audio_file.getnchannels()
-        sample_width = audio_file.getsampwidth()
-        frame_rate = audio_file.getframerate()
-        audio_data = bytearray(list(audio_file.readframes(audio_file.getnframes())))
+    """Load the sample data of a WAV file as a writable uint8 array.
+
+    filename may be a path, the bytes of a WAV file or a readable file object.
+    Paths are mapped copy-on-write: writes stay private to this process and
+    only the pages that are touched are read or copied. Bytes and file
+    objects are read into memory without touching disk.
+    """
+    with span('load_audio') as stage:
+        if isinstance(filename, (bytes, bytearray, memoryview)):
+            num_channels, sample_width, frame_rate, data_offset, data_size = _read_wav_header(io.BytesIO(filename), len(filename))
+            audio_data = np.frombuffer(filename, dtype=np.uint8, count=data_size, offset=data_offset).copy()
+        elif not isinstance(filename, (str, os.PathLike)):
+            num_channels, sample_width, frame_rate, _, data_size = _read_wav_header(filename)
+            audio_data = _read_sample_data(filename, data_size, num_channels * sample_width)
+        else:
+            filepath = _resolve_input_path(os.fspath(filename))
+            with open(filepath, 'rb') as wav_file:
+                file_size = os.fstat(wav_file.fileno()).st_size
+                num_channels, sample_width, frame_rate, data_offset, data_size = _read_wav_header(wav_file, file_size)
+            if data_size:
+                audio_data = np.memmap(filepath, dtype=np.uint8, mode='c', offset=data_offset, shape=(data_size,))
+            else:
+                audio_data = np.zeros(0, dtype=np.uint8)
+        stage.add_bytes(len(audio_data))
     return audio_data, num_channels, sample_width, frame_rate
 
+@contextmanager
+def _atomic_output_path(filepath):
+    """Yield a temporary path next to filepath and rename it into place on success.
+
+    A source file that is still mapped by load_audio is never truncated
+    underneath the mapping, even when it is also the output path.
+    """
+    temp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+@contextmanager
+def _open_wav_reader(source):
+    """Open a WAV for reading from a path, a readable file object or an open reader."""
+    if isinstance(source, wave.Wave_read):
+        yield source
+        return
+    if isinstance(source, (str, os.PathLike)):
+        source = _resolve_input_path(os.fspath(source))
+    with wave.open(source, 'rb') as reader:
+        yield reader
+
+@contextmanager
+def _open_wav_writer(destination, params):
+    """Open a WAV for writing to a path or a writable file object.
+
+    The frame count is declared up front so the header never has to be
+    patched, which keeps non-seekable destinations usable.
+    """
+    if isinstance(destination, (str, os.PathLike)):
+        with _atomic_output_path(_resolve_output_path(os.fspath(destination))) as temp_path:
+            with wave.open(temp_path, 'wb') as writer:
+                writer.setparams(params)
+                yield writer
+        return
+    with wave.open(destination, 'wb') as writer:
+        writer.setparams(params)
+        yield writer
+
 def save_audio(filename, audio_data, num_channels, sample_width, frame_rate):
-    filepath = _resolve_output_path(filename)
-    with wave.open(filepath, 'wb') as audio_file:
-        audio_file.setnchannels(num_channels)
-        audio_file.setsampwidth(sample_width)
-        audio_file.setframerate(frame_rate)
+    """Write sample bytes as a WAV to a path or a writable file object."""
+    num_frames = len(audio_data) // (num_channels * sample_width)
+    params = (num_channels, sample_width, frame_rate, num_frames, 'NONE', 'not compressed')
+    with span('save_audio', len(audio_data)), _open_wav_writer(filename, params) as audio_file:
         audio_file.writeframes(audio_data)
     
-def text_watermark(message, filename):
+def _split_ranges(total, workers, min_size=PARALLEL_MIN_BYTES):
+    """Split range(total) into at most workers contiguous (start, stop) ranges."""
+    if workers is None:
+        workers = PARALLEL_WORKERS
+    count = max(1, min(workers, total // max(min_size, 1)))
+    bounds = [total * i // count for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _run_ranges(function, ranges):
+    """Call function(start, stop) for every range, on a thread pool when there are several.
+
+    The NumPy operations each range runs release the GIL, so the ranges of
+    one buffer are processed on separate cores.
+    """
+    if len(ranges) == 1:
+        function(*ranges[0])
+        return
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        for future in [executor.submit(function, start, stop) for start, stop in ranges]:
+            future.result()
+
+def _payload_bits(payload, workers=None):
+    """Expand payload bytes into a uint8 array of bits, most significant bit first."""
+    payload = np.frombuffer(payload, dtype=np.uint8)
+    with span('payload_bits', len(payload)):
+        ranges = _split_ranges(len(payload), workers, PARALLEL_MIN_BYTES // 8)
+        if len(ranges) == 1:
+            return np.unpackbits(payload)
+        bits = np.empty(len(payload) * 8, dtype=np.uint8)
+
+        def expand(start, stop):
+            bits[start * 8:stop * 8] = np.unpackbits(payload[start:stop])
+        _run_ranges(expand, ranges)
+    return bits
+
+def _as_carrier(audio_data):
+    """View audio_data as a uint8 array without copying."""
+    if isinstance(audio_data, np.ndarray):
+        return audio_data
+    return np.frombuffer(audio_data, dtype=np.uint8)
+
+def _carrier(audio_data, num_channels, sample_width, codec=CODEC_BYTE, channel=None):
+    """Return a view of the bytes of audio_data whose bit 0 carries payload bits.
+
+    The byte codec uses every byte, as older carriers do. The sample codec
+    uses only the low byte of each little-endian PCM sample, of every channel
+    or of one channel, so each payload bit flips a true sample LSB. A strided
+    uint8 view covers 8, 16, 24 and 32-bit samples alike.
+    """
+    data = _as_carrier(audio_data)
+    if codec == CODEC_BYTE:
+        if channel is not None:
+            raise ValueError('Embedding into one channel needs the sample codec')
+        return data
+    if codec != CODEC_SAMPLE:
+        raise ValueError(f'Unknown codec: {codec}')
+    if channel is None:
+        return data[::sample_width]
+    if not 0 <= channel < num_channels:
+        raise ValueError(f'Channel {channel} out of range for {num_channels}-channel audio')
+    return data.reshape(-1, num_channels, sample_width)[:, channel, 0]
+
+def _resolve_codec(codec, header, channel=None):
+    # Headerless carriers keep the legacy byte layout: without a header to
+    # record any other, extraction could not find the payload
+    if header:
+        return codec or CODEC_SAMPLE
+    if codec not in (None, CODEC_BYTE) or channel is not None:
+        raise ValueError('Headerless payloads need the byte codec on every channel')
+    return CODEC_BYTE
+
+def _layout_flags(codec, channel):
+    flags = FLAG_SAMPLE_LSB if codec == CODEC_SAMPLE else 0
+    if channel is not None:
+        flags |= FLAG_SINGLE_CHANNEL | channel << 8
+    return flags
+
+def _candidate_layouts(num_channels, sample_width):
+    """Every (codec, channel) layout a headered payload may have been written with."""
+    layouts = [(CODEC_SAMPLE, None)]
+    if sample_width > 1:
+        layouts.append((CODEC_BYTE, None))
+    if num_channels > 1:
+        layouts.extend((CODEC_SAMPLE, channel) for channel in range(num_channels))
+    return layouts
+
+def capacity_samples(num_frames, num_channels, sample_width, codec=CODEC_SAMPLE, channel=None):
+    """Number of carrier samples (payload bits) a layout offers for num_frames frames."""
+    if codec == CODEC_BYTE:
+        return num_frames * num_channels * sample_width
+    return num_frames * (num_channels if channel is None else 1)
+
+def _embed_bits(audio_data, bits, workers=None):
+    """Write bits into the LSB of the leading bytes of audio_data, in place.
+
+    With several workers the bits are split into disjoint ranges embedded in
+    parallel; every byte depends only on its own bit, so the result is the
+    same as the serial path.
+    """
+    carrier = _as_carrier(audio_data)
+    if len(bits) > len(carrier):
+        raise ValueError('Watermark too large for audio file')
+
+    def embed(start, stop):
+        target = carrier[start:stop]
+        target &= 0xFE
+        target |= bits[start:stop]
+    with span('embed_bits', len(bits) // 8):
+        _run_ranges(embed, _split_ranges(len(bits), workers))
+    return len(bits)
+
+def _extract_bytes(audio_data, num_bytes=None, start=0, workers=None):
+    """Pack the LSBs of audio_data back into payload bytes.
+
+    Reads num_bytes payload bytes starting at payload byte offset start, or
+    everything from start onwards when num_bytes is None. With several
+    workers, disjoint byte ranges are packed in parallel.
+    """
+    carrier = _as_carrier(audio_data)
+    available = max(len(carrier) // 8 - start, 0)
+    if num_bytes is None or num_bytes > available:
+        num_bytes = available
+    with span('extract_bytes', num_bytes):
+        ranges = _split_ranges(num_bytes, workers, PARALLEL_MIN_BYTES // 8)
+        if len(ranges) == 1:
+            return np.packbits(carrier[start * 8:(start + num_bytes) * 8] & 1).tobytes()
+        payload = np.empty(num_bytes, dtype=np.uint8)
+
+        def pack(first, stop):
+            payload[first:stop] = np.packbits(carrier[(start + first) * 8:(start + stop) * 8] & 1)
+        _run_ranges(pack, ranges)
+    return payload.tobytes()
+
+def _decode_until_terminator(payload_blocks):
+    """Decode latin-1 text from payload blocks, stopping at the first terminator."""
+    decoded = ''
+    for payload in payload_blocks:
+        decoded += payload.decode('latin-1')
+        # Only the tail can hold a terminator that straddles two blocks
+        if TEXT_TERMINATOR in decoded[-(len(payload) + len(TEXT_TERMINATOR)):]:
+            break
+    return decoded.split(TEXT_TERMINATOR)[0]
+
+def _pack_header(payload_type, length, checksum, width=0, height=0, num_channels=0, sample_width=0, frame_rate=0, flags=0):
+    return _HEADER_FORMAT.pack(
+        PAYLOAD_MAGIC, PAYLOAD_VERSION, payload_type, flags, length,
+        width, height, num_channels, sample_width, frame_rate, checksum,
+    )
+
+def _parse_header(header_bytes):
+    """Parse a payload header, returning None when the carrier has no header."""
+    if len(header_bytes) < HEADER_BYTES:
+        return None
+    magic, version, *fields = _HEADER_FORMAT.unpack(header_bytes[:HEADER_BYTES])
+    if magic != PAYLOAD_MAGIC:
+        return None
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f'Unsupported watermark header version: {version}')
+    return PayloadHeader(*fields)
+
+def _check_payload_type(header, payload_type):
+    if header.payload_type != payload_type:
+        raise ValueError(f'Watermark holds payload type {header.payload_type}, expected {payload_type}')
+
+def _verify_payload(payload, header):
+    if len(payload) != header.length or zlib.crc32(payload) != header.checksum:
+        raise ValueError('Watermark payload is truncated or corrupted')
+
+def read_payload_header(audio_data):
+    """Return the PayloadHeader embedded in audio_data, or None for legacy carriers."""
+    return _parse_header(_extract_bytes(audio_data, HEADER_BYTES))
+
+def _locate_payload(audio_data, num_channels, sample_width):
+    """Find the carrier layout a payload header was written with.
+
+    Returns (header, carrier). Without a header the carrier is the legacy
+    byte layout.
+    """
+    for codec, channel in _candidate_layouts(num_channels, sample_width):
+        carrier = _carrier(audio_data, num_channels, sample_width, codec, channel)
+        header = read_payload_header(carrier)
+        if header is not None:
+            return header, carrier
+    return None, _as_carrier(audio_data)
+
+def _read_payload(audio_data, header, limit, workers=None):
+    """Read exactly the payload described by header, verify it and decompress it.
+
+    limit is the sample data size of the host, which a payload may not
+    unpack to more than.
+    """
+    payload = _extract_bytes(audio_data, header.length, HEADER_BYTES, workers)
+    _verify_payload(payload, header)
+    return _decompress_payload(payload, header, limit)
+
+def _compression_flags(compression, header=True, payload_type=None):
+    if compression is None:
+        return 0
+    if compression not in _COMPRESSION_FLAGS:
+        raise ValueError(f'Unknown compression: {compression}')
+    if not header:
+        raise ValueError('Compressed payloads need the payload header')
+    if compression == COMPRESSION_PNG and payload_type != PAYLOAD_IMAGE:
+        raise ValueError('PNG compression only applies to image payloads')
+    return _COMPRESSION_FLAGS[compression]
+
+def _header_compression(header):
+    for compression, flag in _COMPRESSION_FLAGS.items():
+        if header.flags & flag:
+            return compression
+    return None
+
+def _compress_payload(payload, compression, width=0, height=0):
+    """Compress payload bytes, prefixed with their uncompressed length."""
+    if compression is None:
+        return payload
+    if compression == COMPRESSION_ZLIB:
+        compressed = zlib.compress(payload)
+    elif compression == COMPRESSION_LZMA:
+        compressed = lzma.compress(payload)
+    else:
+        png = io.BytesIO()
+        Image.frombytes('L', (width, height), bytes(payload)).save(png, format='PNG', optimize=True)
+        compressed = png.getvalue()
+    return _RAW_LENGTH.pack(len(payload)) + compressed
+
+def _check_raw_length(payload, limit):
+    """Return the uncompressed length a payload claims, rejecting one over limit."""
+    if len(payload) < _RAW_LENGTH.size:
+        raise ValueError('Watermark payload is truncated or corrupted')
+    raw_length, = _RAW_LENGTH.unpack_from(payload)
+    # The length comes from the carrier, so it is checked before anything is unpacked
+    if raw_length > limit:
+        raise ValueError('Watermark payload is truncated or corrupted')
+    return raw_length
+
+def _decompress_payload(payload, header, limit):
+    compression = _header_compression(header)
+    if compression is None:
+        return payload
+    raw_length = _check_raw_length(payload, limit)
+    compressed = payload[_RAW_LENGTH.size:]
+    try:
+        if compression == COMPRESSION_PNG:
+            image = Image.open(io.BytesIO(compressed))
+            if image.size != (header.width, header.height) or header.width * header.height != raw_length:
+                raise ValueError('Watermark payload is truncated or corrupted')
+            raw = image.convert('L').tobytes()
+        else:
+            # One byte past raw_length is enough to tell the payload lied
+            raw = _decompressor(compression).decompress(compressed, raw_length + 1)
+    except (zlib.error, lzma.LZMAError, OSError):
+        raise ValueError('Watermark payload is truncated or corrupted')
+    if len(raw) != raw_length:
+        raise ValueError('Watermark payload is truncated or corrupted')
+    return raw
+
+def _compressor(compression):
+    return zlib.compressobj() if compression == COMPRESSION_ZLIB else lzma.LZMACompressor()
+
+def _decompressor(compression):
+    return zlib.decompressobj() if compression == COMPRESSION_ZLIB else lzma.LZMADecompressor()
+
+def _with_header(payload, payload_type, compression=None, flags=0, **params):
+    """Prefix payload bytes, compressed if asked, with a header describing them."""
+    flags |= _compression_flags(compression, True, payload_type)
+    payload = _compress_payload(payload, compression, params.get('width', 0), params.get('height', 0))
+    return _pack_header(payload_type, len(payload), zlib.crc32(payload), flags=flags, **params) + bytes(payload)
+
+def watermark_digest(payload):
+    """Compact fingerprint of an embedded payload, stored instead of its bits."""
+    return {"length": len(payload), "sha256": hashlib.sha256(payload).hexdigest()}
+
+def bits_to_digest(bits):
+    """Convert the per-bit list stored by older sessions into a watermark digest."""
+    return watermark_digest(np.packbits(np.asarray(bits, dtype=np.uint8)).tobytes())
+
+def payload_size(text=None, image=None, watermark=None, header=True):
+    """Bytes a text, image or watermark WAV will occupy once embedded.
+
+    Images are opened lazily, so only their header is read to learn the
+    dimensions; watermark WAVs are sized from their RIFF header.
+    """
+    if text is not None:
+        size = len(text.encode('utf-8')) if header else len(text) + len(TEXT_TERMINATOR)
+    elif image is not None:
+        if isinstance(image, (str, os.PathLike)):
+            image = _resolve_input_path(os.fspath(image))
+        with Image.open(image) as opened:
+            width, height = opened.size
+        size = width * height
+    elif watermark is not None:
+        size = _read_wav_info(watermark)[3]
+    else:
+        raise ValueError('A text, image or watermark is required')
+    return size + (HEADER_BYTES if header else 0)
+
+def watermark_capacity(filename, text=None, image=None, watermark=None, header=True, codec=None, channel=None):
+    """Check how much payload a host WAV can carry without reading its samples.
+
+    Only the RIFF/fmt header of the host, and the header of an image or
+    watermark WAV payload, are read. Returns the capacity in samples and
+    bytes, and when a payload is given its size and whether it fits.
+    """
+    num_channels, sample_width, frame_rate, data_size = _read_wav_info(filename)
+    codec = _resolve_codec(codec, header, channel)
+    # Validate the layout exactly as embedding would
+    _carrier(np.zeros(num_channels * sample_width, dtype=np.uint8), num_channels, sample_width, codec, channel)
+    num_frames = data_size // (num_channels * sample_width)
+    samples = capacity_samples(num_frames, num_channels, sample_width, codec, channel)
+    capacity = {
+        "num_channels": num_channels,
+        "sample_width": sample_width,
+        "frame_rate": frame_rate,
+        "num_frames": num_frames,
+        "codec": codec,
+        "channel": channel,
+        "capacity_samples": samples,
+        "capacity_bytes": max(samples // 8 - (HEADER_BYTES if header else 0), 0),
+    }
+    if text is not None or image is not None or watermark is not None:
+        needed = payload_size(text, image, watermark, header)
+        capacity["payload_bytes"] = needed - (HEADER_BYTES if header else 0)
+        capacity["fits"] = needed * 8 <= samples
+    return capacity
+
+def _text_payload(message, header, flags=0, compression=None):
+    if header:
+        return _with_header(message.encode('utf-8'), PAYLOAD_TEXT, compression, flags)
+    _compression_flags(compression, header)
+    return (message + TEXT_TERMINATOR).encode('latin-1')
+
+def text_watermark(message, filename, header=True, output='wtext.wav', codec=None, channel=None, compression=None):
     audio_data, num_channels, sample_width, frame_rate= load_audio(filename)
-    message = message+ '#####'
-    message = message + int((len(audio_data)-(len(message)*8*8))/8) *'#'
-    bits = list(map(int, ''.join([bin(ord(i)).lstrip('0b').rjust(8,'0') for i in message])))
-    for i, bit in enumerate(bits):
-        audio_data[i] =bit | (2**8-2 & audio_data[i])
+    codec = _resolve_codec(codec, header, channel)
+    carrier = _carrier(audio_data, num_channels, sample_width, codec, channel)
+    _embed_bits(carrier, _payload_bits(_text_payload(message, header, _layout_flags(codec, channel), compression)))
     
-    audio_data_modified = bytes(audio_data)
-    save_audio('wtext.wav', audio_data_modified, num_channels, sample_width, frame_rate)
+    save_audio(output, audio_data, num_channels, sample_width, frame_rate)
     print('Watermarking done')
 
+def text_watermark_batch(messages, filename, outputs, header=True, max_workers=None, codec=None, channel=None, compression=None, on_output=None):
+    """Embed each message into its own copy of one host file.
+
+    The host is decoded once and shared read-only; each output only copies
+    the leading frames its payload modifies and streams the untouched rest
+    straight from the shared buffer. Outputs are written in parallel on a
+    thread pool. Returns the number of bits embedded for each message.
+
+    on_output(index, bits) is called on the worker thread as soon as
+    outputs[index] is written, so in-memory outputs can be handed off and
+    released one by one instead of all being held until the batch ends.
+    """
+    if len(messages) != len(outputs):
+        raise ValueError('Each message needs exactly one output')
+    audio_data, num_channels, sample_width, frame_rate = load_audio(filename)
+    frame_size = num_channels * sample_width
+    params = (num_channels, sample_width, frame_rate, len(audio_data) // frame_size, 'NONE', 'not compressed')
+    codec = _resolve_codec(codec, header, channel)
+    flags = _layout_flags(codec, channel)
+    bits_per_frame = capacity_samples(1, num_channels, sample_width, codec, channel)
+
+    def embed_one(index, message, output):
+        bits = _payload_bits(_text_payload(message, header, flags, compression))
+        # Copy whole frames so the frame count of each write stays exact
+        prefix_size = min(-(-len(bits) // bits_per_frame) * frame_size, len(audio_data))
+        prefix = np.array(audio_data[:prefix_size])
+        embedded = _embed_bits(_carrier(prefix, num_channels, sample_width, codec, channel), bits)
+        with span('save_audio', len(audio_data)), _open_wav_writer(output, params) as writer:
+            writer.writeframesraw(prefix)
+            writer.writeframesraw(audio_data[prefix_size:])
+        if on_output is not None:
+            on_output(index, embedded)
+        return embedded
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(embed_one, range(len(messages)), messages, outputs))
+
 def extract_text_watermark(filename):
-    audio_data, _, _, _ = load_audio(filename)
-    extracted = [audio_data[i] & 1 for i in range(len(audio_data))]
-    string = "".join(chr(int("".join(map(str,extracted[i:i+8])),2)) for i in range(0,len(extracted),8))
-    decode = string.split("#####")[0]
-    return decode
+    audio_data, num_channels, sample_width, _ = load_audio(filename)
+    header, carrier = _locate_payload(audio_data, num_channels, sample_width)
+    if header is not None:
+        _check_payload_type(header, PAYLOAD_TEXT)
+        return _read_payload(carrier, header, len(audio_data)).decode('utf-8')
+    num_blocks = -(-len(carrier) // (TEXT_BLOCK_BYTES * 8))
+    blocks = (_extract_bytes(carrier, TEXT_BLOCK_BYTES, i * TEXT_BLOCK_BYTES) for i in range(num_blocks))
+    return _decode_until_terminator(blocks)
 
-def audio_watermark(filename_audio, filename_watermark):
+def audio_watermark(filename_audio, filename_watermark, header=True, output='waudio.wav', workers=None, codec=None, channel=None, compression=None):
     audio_data, num_channels, sample_width, frame_rate = load_audio(filename_audio)
-    watermark_data, _, _, _ = load_audio(filename_watermark)
+    watermark_data, wm_channels, wm_sample_width, wm_frame_rate = load_audio(filename_watermark)
+    codec = _resolve_codec(codec, header, channel)
+    carrier = _carrier(audio_data, num_channels, sample_width, codec, channel)
 
-    small_audio_bits = []
-    for byte in watermark_data:
-        small_audio_bits.extend([int(bit) for bit in bin(byte)[2:].rjust(8, '0')])
-    if len(small_audio_bits) > len(audio_data):
-        raise ValueError('Watermark too large for audio file')
-    else:
-        for i, bit in enumerate(small_audio_bits):
-            audio_data[i] = (audio_data[i] & 0xFE) | bit
+    flags = _layout_flags(codec, channel) | _compression_flags(compression, header, PAYLOAD_AUDIO)
+    stored = _compress_payload(watermark_data, compression)
+    embedded_bits = _payload_bits(stored, workers)
+    if header:
+        header_bytes = _pack_header(
+            PAYLOAD_AUDIO, len(stored), zlib.crc32(stored),
+            num_channels=wm_channels, sample_width=wm_sample_width, frame_rate=wm_frame_rate,
+            flags=flags,
+        )
+        embedded_bits = np.concatenate((_payload_bits(header_bytes), embedded_bits))
+    _embed_bits(carrier, embedded_bits, workers)
     
-    # Save to a temp location that can be moved later
-    temp_output = _resolve_output_path("waudio.wav")
-    save_audio(temp_output, audio_data, num_channels, sample_width, frame_rate)
-    return(small_audio_bits)
+    save_audio(output, audio_data, num_channels, sample_width, frame_rate)
+    return watermark_digest(watermark_data)
+
 
+def extract_audio_watermark(filename, digest, output='ewaudio.wav', workers=None):
+    """Extract embedded audio if it matches the digest returned by audio_watermark.
 
-def extract_audio_watermark(filename, small_audio_bits):
+    The per-bit list older sessions stored is still accepted in place of a
+    digest. Returns whether the audio matched and was written to output.
+    """
+    if not isinstance(digest, dict):
+        digest = bits_to_digest(digest)
     # Use the provided filename instead of hardcoded path
     audio_data, num_channels, sample_width, frame_rate = load_audio(filename)
-    extracted_bits = []
-
-    for byte in audio_data:
-        lsb = byte & 1  
-        extracted_bits.append(lsb)
-
-    if extracted_bits[:len(small_audio_bits)] == small_audio_bits:
-        num_bits_in_hidden_audio = len(extracted_bits)
-        num_bytes_in_hidden_audio = num_bits_in_hidden_audio // 8
-
-        extracted_audio_data = bytearray()
-        for i in range(0, num_bytes_in_hidden_audio * 8, 8):
-            byte_bits = extracted_bits[i:i + 8]
-            byte = int(''.join(map(str, byte_bits)), 2)  
-            extracted_audio_data.append(byte)
 
-        save_audio("ewaudio.wav", extracted_audio_data, num_channels, sample_width, frame_rate)
+    header, carrier = _locate_payload(audio_data, num_channels, sample_width)
+    if header is not None:
+        _check_payload_type(header, PAYLOAD_AUDIO)
+        extracted_audio_data = _read_payload(carrier, header, len(audio_data), workers)
+        num_channels, sample_width, frame_rate = header.num_channels, header.sample_width, header.frame_rate
+    else:
+        extracted_audio_data = _extract_bytes(carrier, digest["length"], workers=workers)
+    if watermark_digest(extracted_audio_data) != digest:
+        return False
+    save_audio(output, extracted_audio_data, num_channels, sample_width, frame_rate)
+    return True
 
-def extract_audio_watermark_direct(filename):
+def extract_audio_watermark_direct(filename, output='ewaudio.wav', workers=None):
     """Extract embedded audio from watermarked file without requiring original bits"""
     audio_data, num_channels, sample_width, frame_rate = load_audio(filename)
-    extracted_bits = []
-
-    for byte in audio_data:
-        lsb = byte & 1  
-        extracted_bits.append(lsb)
 
-    # Try to extract audio by analyzing the bit pattern
-    # We'll extract up to a reasonable length (e.g., first 100KB worth of bits)
-    max_bits = min(len(extracted_bits), 100000 * 8)  # 100KB max
-    
-    # Convert bits to bytes
-    num_bits_for_extraction = (max_bits // 8) * 8  # Round down to nearest byte
-    extracted_audio_data = bytearray()
-    
-    for i in range(0, num_bits_for_extraction, 8):
-        byte_bits = extracted_bits[i:i + 8]
-        if len(byte_bits) == 8:  # Only process complete bytes
-            byte = int(''.join(map(str, byte_bits)), 2)  
-            extracted_audio_data.append(byte)
+    header, carrier = _locate_payload(audio_data, num_channels, sample_width)
+    if header is not None:
+        # The header records the exact length and format of the hidden audio
+        _check_payload_type(header, PAYLOAD_AUDIO)
+        extracted_audio_data = _read_payload(carrier, header, len(audio_data), workers)
+        num_channels, sample_width, frame_rate = header.num_channels, header.sample_width, header.frame_rate
+    else:
+        # Try to extract audio by analyzing the bit pattern
+        # We'll extract up to a reasonable length (e.g., first 100KB worth of bits)
+        extracted_audio_data = _extract_bytes(carrier, 100000)  # 100KB max
 
     # Save the extracted audio
-    save_audio("ewaudio.wav", extracted_audio_data, num_channels, sample_width, frame_rate)
+    save_audio(output, extracted_audio_data, num_channels, sample_width, frame_rate)
     return len(extracted_audio_data)
 
-def image_watermark(audio, wimage):
+def image_watermark(audio, wimage, header=True, output='wiaudio.wav', workers=None, codec=None, channel=None, compression=None):
     audio_data, num_channels, sample_width, frame_rate = load_audio(audio)
-    image_path = _resolve_input_path(wimage)
-    image = Image.open(image_path).convert('L')
+    codec = _resolve_codec(codec, header, channel)
+    carrier = _carrier(audio_data, num_channels, sample_width, codec, channel)
+    if isinstance(wimage, (str, os.PathLike)):
+        wimage = _resolve_input_path(os.fspath(wimage))
+    image = Image.open(wimage).convert('L')
     width, height = image.size
     image_array = np.array(image)
-    image_1d_array = image_array.flatten()
-    image_bits = [format(pixel, '08b') for pixel in image_1d_array] 
-    image_bits = ''.join(image_bits)
 
-    watermark_bits = list(map(int, image_bits)) 
+    flags = _layout_flags(codec, channel) | _compression_flags(compression, header, PAYLOAD_IMAGE)
+    stored = _compress_payload(image_array.tobytes(), compression, width, height)
+    watermark_bits = _payload_bits(stored, workers)
+    embedded_bits = watermark_bits
+    if header:
+        header_bytes = _pack_header(
+            PAYLOAD_IMAGE, len(stored), zlib.crc32(stored),
+            width=width, height=height, num_channels=1, sample_width=1,
+            flags=flags,
+        )
+        embedded_bits = np.concatenate((_payload_bits(header_bytes), watermark_bits))
 
-    if len(watermark_bits) > len(audio_data):
+    if len(embedded_bits) > len(carrier):
         raise ValueError("The image is too large to fit into the audio!")
-    for i, bit in enumerate(watermark_bits):
-        audio_data[i] = (audio_data[i] & 0xFE) | bit  
+    _embed_bits(carrier, embedded_bits, workers)
 
-    save_audio('wiaudio.wav', audio_data, num_channels, sample_width, frame_rate)
+    save_audio(output, audio_data, num_channels, sample_width, frame_rate)
     return width, height, len(watermark_bits)
 
-def extract_image_watermark(audio, width, height, index):
-    audio_data, _, _, _ = load_audio(audio)
+def _save_extracted_image(byte_values, width, height, output):
+    image_array = np.frombuffer(byte_values, dtype=np.uint8, count=width * height).reshape((height, width))
+    image = Image.fromarray(image_array, mode='L')
+    if isinstance(output, (str, os.PathLike)):
+        output = _resolve_output_path(os.fspath(output))
+    image.save(output, format='JPEG')
+
+def extract_image_watermark(audio, width, height, index, output='extracted_image.jpg', workers=None):
+    audio_data, num_channels, sample_width, _ = load_audio(audio)
+
+    header, carrier = _locate_payload(audio_data, num_channels, sample_width)
+    if header is not None:
+        _check_payload_type(header, PAYLOAD_IMAGE)
+        _save_extracted_image(_read_payload(carrier, header, len(audio_data), workers), header.width, header.height, output)
+        return
+    byte_values = _extract_bytes(carrier, index // 8, workers=workers)
+    _save_extracted_image(byte_values, width, height, output)
+
+def _image_scan_bytes(dimensions=IMAGE_DIMENSIONS):
+    # Enough bytes for the largest candidate plus the margin scored past it
+    return max(width * (height + IMAGE_MARGIN_ROWS + 1) for width, height in dimensions)
+
+def score_image_dimensions(byte_values, dimensions=IMAGE_DIMENSIONS):
+    """Score candidate (width, height) pairs against one buffer of extracted bytes.
 
-    extracted_bits = []
-    for byte in audio_data:
-        lsb = byte & 1  
-        extracted_bits.append(lsb)
+    Rows of a real image resemble the rows below them, while bytes past the
+    image are host noise. Each candidate scores the contrast between the
+    mean row-to-row difference inside its area and in the rows just past
+    it: close to 1 for the true size, around 0 for a wrong width, -1 when
+    the buffer is too short. Rows are differenced once per distinct width.
+    Returns a list of ((width, height), score) in the order of dimensions.
+    """
+    pixels = np.frombuffer(byte_values, dtype=np.uint8)
+    scores = {}
+    for width in {width for width, _ in dimensions}:
+        heights = [height for candidate_width, height in dimensions if candidate_width == width]
+        num_rows = min(len(pixels) // width, max(heights) + IMAGE_MARGIN_ROWS + 1)
+        rows = pixels[:num_rows * width].reshape(num_rows, width).astype(np.int16)
+        # row_diffs[r] compares row r with row r + 1
+        row_diffs = np.abs(np.diff(rows, axis=0)).mean(axis=1)
+        for height in heights:
+            if height < 2 or height > num_rows:
+                scores[width, height] = -1.0
+                continue
+            inside = row_diffs[:height - 1].mean()
+            margin = row_diffs[height:height + IMAGE_MARGIN_ROWS]
+            outside = margin.mean() if len(margin) else _RANDOM_BYTE_DIFF
+            scores[width, height] = float((outside - inside) / (outside + inside)) if outside + inside else 0.0
+    return [((width, height), scores[width, height]) for width, height in dimensions]
+
+def _best_image_dimensions(scores):
+    """Pick the winning dimensions from score_image_dimensions, or None."""
+    best = max(score for _, score in scores)
+    if best < IMAGE_MIN_SCORE:
+        return None
+    # max keeps the first of equal areas, so earlier (more common) sizes win ties
+    return max((dimensions for dimensions, score in scores if score >= best - IMAGE_SCORE_TOLERANCE),
+               key=lambda dimensions: dimensions[0] * dimensions[1])
 
-    extracted_bits = extracted_bits[:index]
-    byte_values = [int(''.join(map(str, extracted_bits[i:i+8])), 2) for i in range(0, len(extracted_bits), 8)]
-    image_array = np.array(byte_values, dtype=np.uint8).reshape((height, width))
-    image = Image.fromarray(image_array, mode='L')  
-    image.save(_resolve_output_path("extracted_image.jpg"))
+def image_dimension_scores(filename):
+    """Debugging aid: rank the image sizes extract_image_watermark_direct considers.
 
-def extract_image_watermark_direct(filename):
+    Returns ((width, height), score) pairs, best first. A headered carrier
+    has exactly one candidate, the size recorded in its header.
+    """
+    audio_data, num_channels, sample_width, _ = load_audio(filename)
+    header, carrier = _locate_payload(audio_data, num_channels, sample_width)
+    if header is not None:
+        _check_payload_type(header, PAYLOAD_IMAGE)
+        return [((header.width, header.height), 1.0)]
+    scores = score_image_dimensions(_extract_bytes(carrier, _image_scan_bytes()))
+    return sorted(scores, key=lambda item: -item[1])
+
+def extract_image_watermark_direct(filename, output='extracted_image.jpg', workers=None):
     """Extract embedded image using YOUR exact logic from extract_image_watermark
     Just need to find the right width, height, and index parameters
     """
     # Load audio data once to avoid repeated loading
-    audio_data, _, _, _ = load_audio(filename)
+    audio_data, num_channels, sample_width, _ = load_audio(filename)
     
-    # Extract all LSB bits once
-    extracted_bits = []
-    for byte in audio_data:
-        lsb = byte & 1  
-        extracted_bits.append(lsb)
+    # Headered carriers say exactly where the image is, no search needed
+    header, carrier = _locate_payload(audio_data, num_channels, sample_width)
+    if header is not None:
+        _check_payload_type(header, PAYLOAD_IMAGE)
+        _save_extracted_image(_read_payload(carrier, header, len(audio_data), workers), header.width, header.height, output)
+        return header.width, header.height, header.length * 8
     
-    # Common image sizes to test - prioritize most common sizes first
-    test_dimensions = [
-        # Most common sizes first - these are likely to be the correct ones
-        (500, 375), (640, 480), (800, 600), (400, 300), (320, 240),
-        # Square sizes (common for smaller images)
-        (256, 256), (128, 128), (512, 512), (64, 64),
-        # Other rectangle sizes  
-        (100, 80), (120, 90), (150, 100), (200, 150), (300, 200),
-        (80, 100), (90, 120), (100, 150), (150, 200), (240, 320),
-        (300, 400), (480, 640), (600, 800)
-    ]
-    
-    # Try each dimension combination
-    for width, height in test_dimensions:
-        index = width * height * 8  # Total bits needed
-        
-        # Make sure we have enough bits
-        if len(extracted_bits) < index:
-            continue
-            
-        try:
-            # YOUR EXACT LOGIC FROM extract_image_watermark:
-            extracted_bits_for_image = extracted_bits[:index]
-            byte_values = [int(''.join(map(str, extracted_bits_for_image[i:i+8])), 2) for i in range(0, len(extracted_bits_for_image), 8)]
-            
-            # Only proceed if we got the right number of bytes
-            expected_pixels = width * height
-            if len(byte_values) >= expected_pixels:
-                # YOUR EXACT RESHAPE LOGIC:
-                image_array = np.array(byte_values[:expected_pixels], dtype=np.uint8).reshape((height, width))
-                
-                # Quick quality check - real images have reasonable variance and mean
-                variance = np.var(image_array.astype(float))
-                mean_val = np.mean(image_array)
-                
-                # Good image characteristics: reasonable variance and not too extreme brightness
-                if variance > 100 and 30 < mean_val < 225:
-                    # This looks like a good image, save it
-                    image = Image.fromarray(image_array, mode='L')
-                    image.save(_resolve_output_path("extracted_image.jpg"))
-                    return width, height, index
-                    
-        except Exception:
-            continue
+    # Extract the LSB bytes once, then score every candidate size against them
+    byte_values = _extract_bytes(carrier, _image_scan_bytes(), workers=workers)
+    dimensions = _best_image_dimensions(score_image_dimensions(byte_values))
+    if dimensions is not None:
+        width, height = dimensions
+        _save_extracted_image(byte_values, width, height, output)
+        return width, height, width * height * 8
     
     # If no good image found with exact dimensions, fallback to reasonable size
-    try:
-        # Try a reasonable fallback size using the already extracted bits
-        fallback_width = fallback_height = 256
-        fallback_index = fallback_width * fallback_height * 8
-        
-        if len(extracted_bits) >= fallback_index:
-            # YOUR EXACT LOGIC:
-            extracted_bits_fallback = extracted_bits[:fallback_index]
-            byte_values = [int(''.join(map(str, extracted_bits_fallback[i:i+8])), 2) for i in range(0, len(extracted_bits_fallback), 8)]
-            
-            if len(byte_values) >= fallback_width * fallback_height:
-                image_array = np.array(byte_values[:fallback_width * fallback_height], dtype=np.uint8).reshape((fallback_height, fallback_width))
-                image = Image.fromarray(image_array, mode='L')
-                image.save(_resolve_output_path("extracted_image.jpg"))
-                return fallback_width, fallback_height, fallback_index
-                
-    except Exception:
-        pass
+    fallback_width = fallback_height = 256
+    fallback_pixels = fallback_width * fallback_height
+    if len(byte_values) >= fallback_pixels:
+        _save_extracted_image(byte_values, fallback_width, fallback_height, output)
+        return fallback_width, fallback_height, fallback_pixels * 8
     
     # Ultimate fallback - return default values
     return 256, 256, 0
 
+def iter_audio_chunks(source, chunk_frames=STREAM_CHUNK_FRAMES):
+    """Yield the raw sample bytes of a WAV file in blocks of chunk_frames frames."""
+    with _open_wav_reader(source) as reader:
+        while True:
+            with span('read_frames') as stage:
+                block = reader.readframes(chunk_frames)
+                stage.add_bytes(len(block))
+            if not block:
+                return
+            yield block
+
+def embed_stream(source, destination, payload_chunks, chunk_frames=STREAM_CHUNK_FRAMES, codec=CODEC_BYTE, channel=None):
+    """Copy a WAV from source to destination block by block, embedding payload_chunks.
+
+    payload_chunks is any iterable of byte blocks. It is only pulled as far
+    as the current block of frames needs, so peak memory is proportional to
+    chunk_frames rather than to the host or payload size. Returns the number
+    of payload bits embedded.
+    """
+    payload = (_payload_bits(chunk) for chunk in payload_chunks if chunk)
+    pending = np.zeros(0, dtype=np.uint8)
+    embedded = 0
+    with _open_wav_reader(source) as reader:
+        num_channels, sample_width = reader.getnchannels(), reader.getsampwidth()
+        with _open_wav_writer(destination, reader.getparams()) as writer:
+            while True:
+                with span('read_frames') as stage:
+                    block = bytearray(reader.readframes(chunk_frames))
+                    stage.add_bytes(len(block))
+                if not block:
+                    break
+                carrier = _carrier(block, num_channels, sample_width, codec, channel)
+                parts = [pending]
+                available = len(pending)
+                while available < len(carrier):
+                    bits = next(payload, None)
+                    if bits is None:
+                        break
+                    parts.append(bits)
+                    available += len(bits)
+                pending = np.concatenate(parts)
+                if len(pending):
+                    used = _embed_bits(carrier, pending[:len(carrier)])
+                    pending = pending[used:]
+                    embedded += used
+                with span('write_frames', len(block)):
+                    writer.writeframesraw(block)
+            if len(pending) or next(payload, None) is not None:
+                raise ValueError('Watermark too large for audio file')
+    return embedded
+
+def extract_stream(source, num_bytes=None, chunk_frames=STREAM_CHUNK_FRAMES, codec=CODEC_BYTE, channel=None):
+    """Yield payload bytes packed from the sample LSBs of a WAV, block by block.
+
+    When num_bytes is given, reading stops as soon as that many bytes have
+    been recovered instead of running to the end of the file.
+    """
+    with _open_wav_reader(source) as reader:
+        num_channels, sample_width = reader.getnchannels(), reader.getsampwidth()
+        yield from _extract_blocks(iter_audio_chunks(reader, chunk_frames), num_channels, sample_width, num_bytes, codec, channel)
+
+def _extract_blocks(blocks, num_channels, sample_width, num_bytes=None, codec=CODEC_BYTE, channel=None):
+    remaining = num_bytes
+    carry = np.zeros(0, dtype=np.uint8)
+    for block in blocks:
+        bits = np.concatenate((carry, _carrier(block, num_channels, sample_width, codec, channel) & 1))
+        usable = len(bits) // 8 * 8
+        if remaining is not None:
+            usable = min(usable, remaining * 8)
+        carry = bits[usable:]
+        payload = np.packbits(bits[:usable]).tobytes()
+        yield payload
+        if remaining is not None:
+            remaining -= len(payload)
+            if remaining <= 0:
+                return
+
+def _split_stream(payload_blocks, num_bytes):
+    """Return the first num_bytes of payload_blocks and an iterator over the rest."""
+    payload_blocks = iter(payload_blocks)
+    head = b''
+    for block in payload_blocks:
+        head += block
+        if len(head) >= num_bytes:
+            break
+    return head[:num_bytes], chain([head[num_bytes:]], payload_blocks)
+
+def _limit_stream(payload_blocks, num_bytes):
+    """Yield payload blocks up to a total of num_bytes."""
+    for block in payload_blocks:
+        if num_bytes <= 0:
+            return
+        block = block[:num_bytes]
+        num_bytes -= len(block)
+        yield block
+
+def _locate_stream_payload(reader, chunk_frames=STREAM_CHUNK_FRAMES):
+    """Find the carrier layout of a stream's payload from its first block.
+
+    Returns (header, payload_blocks): the payload bytes that follow the
+    header, or every payload byte of the legacy byte layout when the
+    stream has no header.
+    """
+    num_channels, sample_width = reader.getnchannels(), reader.getsampwidth()
+    # A single-channel header needs one frame per header bit
+    first = reader.readframes(max(chunk_frames, HEADER_BYTES * 8))
+    for codec, channel in _candidate_layouts(num_channels, sample_width):
+        header = read_payload_header(_carrier(first, num_channels, sample_width, codec, channel))
+        if header is not None:
+            break
+    else:
+        codec, channel = CODEC_BYTE, None
+    blocks = chain([first], iter_audio_chunks(reader, chunk_frames))
+    head, payload_blocks = _split_stream(_extract_blocks(blocks, num_channels, sample_width, None, codec, channel), HEADER_BYTES)
+    if header is None:
+        return None, chain([head], payload_blocks)
+    return header, payload_blocks
+
+def _stream_checksum(payload_blocks):
+    """Return (length, crc32) of a stream of payload blocks."""
+    length = checksum = 0
+    for block in payload_blocks:
+        length += len(block)
+        checksum = zlib.crc32(block, checksum)
+    return length, checksum
+
+def _compress_stream(payload_blocks, compression, output):
+    """Compress payload blocks into output; returns the uncompressed length."""
+    compressor = _compressor(compression)
+    raw_length = 0
+    for block in payload_blocks:
+        raw_length += len(block)
+        output.write(compressor.compress(block))
+    output.write(compressor.flush())
+    return raw_length
+
+def _decompress_stream(payload_blocks, compression, limit):
+    """Return the uncompressed length and an iterator over the decompressed blocks.
+
+    Like _decompress_payload, the stream may not unpack to more than limit
+    bytes, nor to more than the length it claims.
+    """
+    head, payload_blocks = _split_stream(payload_blocks, _RAW_LENGTH.size)
+    raw_length = _check_raw_length(head, limit)
+    decompressor = _decompressor(compression)
+
+    def blocks():
+        produced = 0
+        try:
+            for block in payload_blocks:
+                # Output stops one byte past raw_length, however much the block expands
+                raw = decompressor.decompress(block, raw_length + 1 - produced)
+                produced += len(raw)
+                if produced > raw_length:
+                    raise ValueError('Watermark payload is truncated or corrupted')
+                if raw:
+                    yield raw
+            if compression == COMPRESSION_ZLIB:
+                raw = decompressor.flush()
+                if produced + len(raw) > raw_length:
+                    raise ValueError('Watermark payload is truncated or corrupted')
+                yield raw
+        except (zlib.error, lzma.LZMAError):
+            raise ValueError('Watermark payload is truncated or corrupted')
+    return raw_length, blocks()
+
+def _iter_spool(spool, block_size=1 << 20):
+    spool.seek(0)
+    return iter(lambda: spool.read(block_size), b'')
+
+def _tally_stream(payload_blocks, tally):
+    """Yield payload blocks while accumulating their [length, crc32] in tally."""
+    for block in payload_blocks:
+        tally[0] += len(block)
+        tally[1] = zlib.crc32(block, tally[1])
+        yield block
+
+def text_watermark_stream(message, source, destination, header=True, chunk_frames=STREAM_CHUNK_FRAMES, codec=None, channel=None, compression=None):
+    """Streaming variant of text_watermark."""
+    codec = _resolve_codec(codec, header, channel)
+    payload = _text_payload(message, header, _layout_flags(codec, channel), compression)
+    return embed_stream(source, destination, [payload], chunk_frames, codec, channel)
+
+def extract_text_watermark_stream(source, chunk_frames=STREAM_CHUNK_FRAMES):
+    """Streaming variant of extract_text_watermark that stops at the terminator."""
+    with _open_wav_reader(source) as reader:
+        host_bytes = reader.getnframes() * reader.getnchannels() * reader.getsampwidth()
+        header, blocks = _locate_stream_payload(reader, chunk_frames)
+        if header is None:
+            return _decode_until_terminator(blocks)
+        _check_payload_type(header, PAYLOAD_TEXT)
+        payload, _ = _split_stream(blocks, header.length)
+    _verify_payload(payload, header)
+    return _decompress_payload(payload, header, host_bytes).decode('utf-8')
+
+def audio_watermark_stream(source, watermark_source, destination, header=True, chunk_frames=STREAM_CHUNK_FRAMES, codec=None, channel=None, compression=None):
+    """Streaming variant of audio_watermark; returns the number of embedded bits.
+
+    With a header, the watermark is read twice (once for its checksum), so a
+    file object watermark_source must be seekable. With compression it is
+    read once and compressed into a spooled buffer that only goes to disk
+    past SPOOL_MAX_BYTES.
+    """
+    codec = _resolve_codec(codec, header, channel)
+    flags = _layout_flags(codec, channel) | _compression_flags(compression, header, PAYLOAD_AUDIO)
+    if compression is not None:
+        with _open_wav_reader(watermark_source) as reader:
+            params = reader.getparams()
+            with tempfile.SpooledTemporaryFile(SPOOL_MAX_BYTES) as spool:
+                raw_length = _compress_stream(iter_audio_chunks(reader, chunk_frames), compression, spool)
+                stored = _RAW_LENGTH.pack(raw_length)
+                length, checksum = _stream_checksum(chain([stored], _iter_spool(spool)))
+                header_bytes = _pack_header(
+                    PAYLOAD_AUDIO, length, checksum,
+                    num_channels=params.nchannels, sample_width=params.sampwidth, frame_rate=params.framerate,
+                    flags=flags,
+                )
+                payload = chain([header_bytes, stored], _iter_spool(spool))
+                return embed_stream(source, destination, payload, chunk_frames, codec, channel)
+    payload = iter_audio_chunks(watermark_source, chunk_frames)
+    if header:
+        start = None if isinstance(watermark_source, (str, os.PathLike)) else watermark_source.tell()
+        with _open_wav_reader(watermark_source) as reader:
+            params = reader.getparams()
+            length, checksum = _stream_checksum(iter_audio_chunks(reader, chunk_frames))
+        if start is not None:
+            watermark_source.seek(start)
+        header_bytes = _pack_header(
+            PAYLOAD_AUDIO, length, checksum,
+            num_channels=params.nchannels, sample_width=params.sampwidth, frame_rate=params.framerate,
+            flags=flags,
+        )
+        payload = chain([header_bytes], payload)
+    return embed_stream(source, destination, payload, chunk_frames, codec, channel)
+
+def extract_audio_watermark_direct_stream(source, destination, max_bytes=100000, chunk_frames=STREAM_CHUNK_FRAMES):
+    """Streaming variant of extract_audio_watermark_direct; returns the extracted size."""
+    with _open_wav_reader(source) as reader:
+        params = reader.getparams()
+        host_bytes = params.nframes * params.nchannels * params.sampwidth
+        header, blocks = _locate_stream_payload(reader, chunk_frames)
+        if header is None:
+            frame_size = params.nchannels * params.sampwidth
+            num_bytes = min(max_bytes, params.nframes * frame_size // 8)
+            blocks = _limit_stream(blocks, num_bytes)
+        else:
+            _check_payload_type(header, PAYLOAD_AUDIO)
+            frame_size = header.num_channels * header.sample_width
+            params = params._replace(nchannels=header.num_channels, sampwidth=header.sample_width, framerate=header.frame_rate)
+            # Checksum the stored bytes as they pass, before any decompression
+            tally = [0, 0]
+            blocks = _tally_stream(_limit_stream(blocks, header.length), tally)
+            num_bytes = header.length
+            compression = _header_compression(header)
+            if compression is not None:
+                num_bytes, blocks = _decompress_stream(blocks, compression, host_bytes)
+        params = params._replace(nframes=num_bytes // frame_size)
+
+        extracted_size = 0
+        with _open_wav_writer(destination, params) as writer:
+            for payload in blocks:
+                writer.writeframesraw(payload)
+                extracted_size += len(payload)
+            if header is not None and (tally != [header.length, header.checksum] or extracted_size != num_bytes):
+                raise ValueError('Watermark payload is truncated or corrupted')
+    return extracted_size